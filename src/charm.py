@@ -12,13 +12,25 @@ develop a new k8s charm using the Operator Framework:
     https://discourse.charmhub.io/t/4208
 """
 
+import itertools
 import logging
 import os
 import pathlib
+import re
 from base64 import b64decode
 from binascii import Error as Base64Error
 from functools import wraps
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+)
 
 import yaml
 from charmhelpers.core import hookenv
@@ -33,20 +45,135 @@ from ops.charm import (
     UpdateStatusEvent,
     UpgradeCharmEvent,
 )
+from ops.framework import EventBase
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, ModelError
-from packaging import version
 from prometheus_interface.operator import (
     PrometheusConfigError,
     PrometheusConnected,
     PrometheusScrapeTarget,
 )
 
-from exporter import ExporterConfig, ExporterConfigError, ExporterSnap
+from exporter import ExporterConfig, ExporterConfigError, ExporterSnap, RenderedConfig
+
+if TYPE_CHECKING:
+    import packaging.version
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader
 
 # Log messages can be retrieved using juju debug-log
 logger = logging.getLogger(__name__)
 
+_AGENT_CONF_FIELDS = ("upgradedToVersion", "cacert")
+_AGENT_CONF_KEY_RE = re.compile(r"^(?P<key>[A-Za-z0-9_-]+):(?: +(?P<value>.*?))? *$")
+# Only plain scalars made of these characters are read without YAML parser
+_AGENT_CONF_PLAIN_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.+=/-]*(?: [A-Za-z0-9_.+=/-]+)*$")
+# Lines with other characters (e.g. non-printable or non-ASCII line breaks) need YAML parser
+_AGENT_CONF_LINE_RE = re.compile(r"^[\x20-\x7e\t]*$")
+
+
+def _is_plain_string(value: str) -> bool:
+    """Return True if YAML would load the plain scalar as string, not as null, bool, number etc."""
+    resolvers = yaml.resolver.Resolver.yaml_implicit_resolvers.get(value[0], [])
+    return not any(regexp.match(value) for _, regexp in resolvers)
+
+
+def _literal_block_value(lines: List[str], chomp: str) -> Optional[str]:
+    """Return value of a YAML literal block scalar or None if it's not simple enough to read.
+
+    Lines are expected to include their line breaks. Blocks with empty or whitespace-only lines
+    and blocks with irregular indentation are not read.
+    """
+    if not lines:
+        return None
+
+    indent = len(lines[0]) - len(lines[0].lstrip(" "))
+    for line in lines:
+        if not indent or line[:indent] != " " * indent or not line[indent:].strip():
+            return None
+
+    value = "".join(line[indent:] for line in lines)
+    if chomp == "-" and value.endswith("\n"):
+        return value[:-1]
+    return value
+
+
+def _only_comments(lines: List[str]) -> bool:
+    """Return True if lines contain only blank lines and top-level comments."""
+    return all(not line.strip() or line.startswith("#") for line in lines)
+
+
+def _split_agent_conf(conf_file: TextIO) -> Optional[List[Tuple[str, List[str]]]]:
+    """Split agent.conf into top-level lines, each with the lines that follow it.
+
+    Sequence items at the top-level indentation are kept with the preceding key. None is
+    returned if the file contains characters or indentation that require YAML parser.
+    """
+    entries: List[Tuple[str, List[str]]] = []
+    for line in conf_file:
+        content = line[:-1] if line.endswith("\n") else line
+        if not _AGENT_CONF_LINE_RE.match(content) or content.startswith("\t"):
+            return None
+
+        if content and not content.startswith((" ", "#", "- ")) and content != "-":
+            entries.append((content, []))
+        elif entries:
+            entries[-1][1].append(line)
+        elif not _only_comments([content]):
+            return None  # nested content without a key
+
+    return entries
+
+
+def _agent_conf_value(value: Optional[str], following_lines: List[str]) -> Optional[str]:
+    """Return value of a top-level key in agent.conf or None if it's not simple enough to read."""
+    if value in ("|", "|-"):
+        block = list(
+            itertools.takewhile(lambda line: line.startswith((" ", "\n")), following_lines)
+        )
+        block_end = len(block)
+        if not _only_comments(following_lines[block_end:]):
+            return None  # content continues after a comment or a sequence item
+        return _literal_block_value(block, value[1:])
+
+    # blank lines and comments don't end a plain scalar, it may continue on the next lines
+    if value and _AGENT_CONF_PLAIN_RE.match(value) and _is_plain_string(value):
+        return value if _only_comments(following_lines) else None
+
+    return None
+
+
+def _read_agent_conf_fields(conf_file: TextIO, keys: Iterable[str]) -> Optional[Dict[str, str]]:
+    """Read values of selected top-level keys from agent.conf without parsing the whole YAML.
+
+    Only single-line plain scalars of a restricted character set that resolve to a string and
+    literal block scalars ('|' and '|-') without empty lines are recognized. If any of the
+    requested keys holds other kind of value, or the file has top-level lines that are not
+    simple "key: value" pairs or comments, None is returned and the caller is expected to fall
+    back to a YAML parser.
+    """
+    entries = _split_agent_conf(conf_file)
+    if entries is None:
+        return None
+
+    fields: Dict[str, str] = {}
+    for top_line, following_lines in entries:
+        match = _AGENT_CONF_KEY_RE.match(top_line)
+        if match is None:
+            return None
+        if match.group("key") not in keys:
+            continue
+
+        value = _agent_conf_value(match.group("value"), following_lines)
+        if value is None:
+            return None
+        fields[match.group("key")] = value
+
+    return fields
+
 
 class ControllerIncompatibleError(Exception):
     """The version of the current controller is not supported."""
@@ -78,7 +205,7 @@ def evaluate_status(func: Callable) -> Callable:
     return wrapper
 
 
-class PrometheusJujuExporterCharm(CharmBase):
+class PrometheusJujuExporterCharm(CharmBase):  # pylint: disable=too-many-instance-attributes
     """Charm the service."""
 
     # Mapping between charm and snap configuration options
@@ -94,6 +221,13 @@ class PrometheusJujuExporterCharm(CharmBase):
         "virtual-macs": "detection.virt_macs",
         "match-interfaces": "detection.match_interfaces",
     }
+    _SNAP_TO_CHARM = {
+        snap_option: charm_option for charm_option, snap_option in SNAP_CONFIG_MAP.items()
+    }
+    # Longer options go first so that they are not shadowed by their shorter prefixes
+    _SNAP_OPTION_RE = re.compile(
+        "|".join(re.escape(option) for option in sorted(_SNAP_TO_CHARM, key=len, reverse=True))
+    )
 
     def __init__(self, *args: Any) -> None:
         """Initialize charm."""
@@ -102,6 +236,9 @@ class PrometheusJujuExporterCharm(CharmBase):
         self.prometheus_target = PrometheusScrapeTarget(self, "prometheus-scrape")
         self._snap_path: Optional[str] = None
         self._snap_path_set = False
+        self._agent_conf_cache: Optional[Tuple[Tuple[float, int], Dict[str, Any]]] = None
+        self._controller_version: Optional["packaging.version.Version"] = None
+        self._snap_channel: Optional[str] = None
 
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.install, self._on_install)
@@ -125,7 +262,11 @@ class PrometheusJujuExporterCharm(CharmBase):
         self.grafana_dashboard_provider = GrafanaDashboardProvider(
             self, relation_name="grafana-k8s-dashboard"
         )
-        self.grafana_dashboard_provider._reinitialize_dashboard_data(inject_dropdowns=False)
+        # Built-in dashboards can change only with the charm code, so they are re-read from the
+        # charm directory only on events that may need them refreshed. The result is persisted
+        # in the provider's stored state and reused by every other hook.
+        for event in (self.on.install, self.on.upgrade_charm, self.on.leader_elected):
+            self.framework.observe(event, self._on_reload_dashboards)
 
     @property
     def snap_path(self) -> Optional[str]:
@@ -134,12 +275,16 @@ class PrometheusJujuExporterCharm(CharmBase):
         If this charm has snap file for the exporter attached as a resource, this property returns
         path to the snap file. If the resource was not attached of the file is empty, this property
         returns None.
+
+        The resource is fetched only once per hook. It is intentionally not cached across hooks,
+        because attaching new resource triggers 'upgrade-charm' hook, which is (together with
+        'install') the only hook that needs the snap path.
         """
         if not self._snap_path_set:
             try:
                 self._snap_path = str(self.model.resources.fetch("exporter-snap"))
                 # Don't return path to empty resource file
-                if not os.path.getsize(self._snap_path) > 0:
+                if os.stat(self._snap_path).st_size == 0:
                     self._snap_path = None
             except ModelError:
                 self._snap_path = None
@@ -165,33 +310,67 @@ class PrometheusJujuExporterCharm(CharmBase):
         is set to 3.x/stable.
 
         Otherwise, raise ControllerIncompatibleError exception.
+
+        The channel is determined only once per hook execution.
         """
+        if self._snap_channel is not None:
+            return self._snap_channel
+
         controller_version = self.get_controller_version()
 
         if controller_version.major == 2:
             if controller_version.minor in [6, 7, 8]:
-                return "2.8/stable"
-            if controller_version.minor == 9:
-                return "2.9/stable"
+                self._snap_channel = "2.8/stable"
+            elif controller_version.minor == 9:
+                self._snap_channel = "2.9/stable"
         elif controller_version.major == 3:
-            return "3/stable"
+            self._snap_channel = "3/stable"
 
-        raise ControllerIncompatibleError(
-            f"Juju controller version {str(controller_version)} is not supported. "
-            + "Current supported versions are: 2.6 to 2.9, and 3.x",
-        )
+        if self._snap_channel is None:
+            raise ControllerIncompatibleError(
+                f"Juju controller version {str(controller_version)} is not supported. "
+                + "Current supported versions are: 2.6 to 2.9, and 3.x",
+            )
+
+        return self._snap_channel
 
-    def get_controller_version(self) -> version.Version:
-        """Return the version of the current controller."""
+    def _load_agent_conf(self) -> Dict[str, Any]:
+        """Return parsed content of the unit's agent.conf file.
+
+        Only fields used by the charm are read from the file, falling back to a full YAML parse
+        if their values are too complex for a simple line-based reader. Parsed data are cached
+        and the file is re-parsed only if its modification time or size changed since the last
+        read.
+        """
         agent_conf_path = pathlib.Path(hookenv.charm_dir()).joinpath("../agent.conf")
-        with open(agent_conf_path, "r", encoding="utf-8") as conf_file:
-            agent_conf = yaml.safe_load(conf_file)
+        conf_stat = os.stat(agent_conf_path)
+        cache_key = (conf_stat.st_mtime, conf_stat.st_size)
+
+        if self._agent_conf_cache is None or self._agent_conf_cache[0] != cache_key:
+            with open(agent_conf_path, "r", encoding="utf-8") as conf_file:
+                agent_conf = _read_agent_conf_fields(conf_file, _AGENT_CONF_FIELDS)
+                if agent_conf is None:
+                    conf_file.seek(0)
+                    agent_conf = yaml.load(conf_file, Loader=SafeLoader) or {}
+            self._agent_conf_cache = (cache_key, agent_conf)
 
-        controller_version = agent_conf.get("upgradedToVersion")
-        if not controller_version:
-            raise RuntimeError("Charm failed to fetch controller's version.")
+        return self._agent_conf_cache[1]
 
-        return version.Version(controller_version)
+    def get_controller_version(self) -> "packaging.version.Version":
+        """Return the version of the current controller.
+
+        The version is parsed only once per hook execution.
+        """
+        # Imported here to avoid import overhead in hooks that don't need it
+        from packaging import version  # pylint: disable=import-outside-toplevel
+
+        if self._controller_version is None:
+            controller_version = self._load_agent_conf().get("upgradedToVersion")
+            if not controller_version:
+                raise RuntimeError("Charm failed to fetch controller's version.")
+            self._controller_version = version.Version(controller_version)
+
+        return self._controller_version
 
     def get_controller_ca_cert(self) -> str:
         """Get CA certificate used by targeted Juju controller.
@@ -212,32 +391,31 @@ class PrometheusJujuExporterCharm(CharmBase):
                 )
                 raise RuntimeError("Invalid base64 value in 'controller-ca-cert' option.") from exc
 
-        agent_conf_path = pathlib.Path(hookenv.charm_dir()).joinpath("../agent.conf")
-        with open(agent_conf_path, "r", encoding="utf-8") as conf_file:
-            agent_conf = yaml.safe_load(conf_file)
-
-        ca_cert = agent_conf.get("cacert")
+        ca_cert = self._load_agent_conf().get("cacert")
         if not ca_cert:
             raise RuntimeError("Charm failed to fetch controller's CA certificate.")
 
         return ca_cert
 
-    def generate_exporter_config(
-        self,
-    ) -> Dict[str, Union[Dict[str, Union[List[str], str, None]], str, None]]:
+    def generate_exporter_config(self) -> RenderedConfig:
         """Generate exporter service config based on the values from charm config."""
+        charm_config = dict(self.config)
+        virtual_macs = charm_config.get("virtual-macs")
+        controller = charm_config.get("controller-url")
         config = ExporterConfig(
-            debug=self.config.get("debug"),
-            customer=self.config.get("customer"),
-            cloud=self.config.get("cloud-name"),
-            controller=self.config.get("controller-url"),
+            debug=charm_config.get("debug"),
+            customer=charm_config.get("customer"),
+            cloud=charm_config.get("cloud-name"),
+            controller=controller,
             ca_cert=self.get_controller_ca_cert(),
-            user=self.config.get("juju-user"),
-            password=self.config.get("juju-password"),
-            interval=self.config.get("scrape-interval"),
-            port=self.config.get("scrape-port"),
-            prefixes=self.config.get("virtual-macs"),
-            match_interfaces=self.config.get("match-interfaces"),
+            user=charm_config.get("juju-user"),
+            password=charm_config.get("juju-password"),
+            interval=charm_config.get("scrape-interval"),
+            port=charm_config.get("scrape-port"),
+            prefixes=tuple(virtual_macs.split(",")) if virtual_macs else (),
+            match_interfaces=charm_config.get("match-interfaces"),
+            # snap version only affects format of controller endpoints
+            installed_version=self.exporter.version() if controller else None,
         )
 
         return config.render()
@@ -248,10 +426,10 @@ class PrometheusJujuExporterCharm(CharmBase):
         Note: this function has no effect if there's no application related via
         'prometheus-scrape'.
         """
-        port = self.config["scrape-port"]
-        interval_minutes = self.config["scrape-interval"]
-        interval = interval_minutes * 60
-        timeout = self.config["scrape-timeout"]
+        charm_config = dict(self.config)
+        port = charm_config["scrape-port"]
+        interval = charm_config["scrape-interval"] * 60
+        timeout = charm_config["scrape-timeout"]
         try:
             self.prometheus_target.expose_scrape_target(
                 port, "/metrics", scrape_interval=f"{interval}s", scrape_timeout=f"{timeout}s"
@@ -261,16 +439,25 @@ class PrometheusJujuExporterCharm(CharmBase):
             raise exc
 
     def reconfigure_open_ports(self) -> None:
-        """Update ports that juju shows as 'opened' in units' status."""
+        """Update ports that juju shows as 'opened' in units' status.
+
+        Only ports that differ from the configured 'scrape-port' are closed and the scrape port
+        is opened only if it's not open already.
+        """
         new_port = self.config["scrape-port"]
+        new_port_spec = f"{new_port}/tcp"
+        opened_ports = hookenv.opened_ports()
 
-        for port_spec in hookenv.opened_ports():
+        for port_spec in opened_ports:
+            if port_spec == new_port_spec:
+                continue
             old_port, protocol = port_spec.split("/")
             logger.debug("Setting port %s as closed.", old_port)
             hookenv.close_port(old_port, protocol)
 
-        logger.debug("Setting port %s as opened.", new_port)
-        hookenv.open_port(new_port)
+        if new_port_spec not in opened_ports:
+            logger.debug("Setting port %s as opened.", new_port)
+            hookenv.open_port(new_port)
 
     def _on_install(self, _: Optional[InstallEvent]) -> None:
         """Install prometheus-juju-exporter snap."""
@@ -305,9 +492,9 @@ class PrometheusJujuExporterCharm(CharmBase):
             self.exporter.apply_config(exporter_config)
         except ExporterConfigError as exc:
             # Replace snap config names with their charm equivalents
-            err_msg = str(exc)
-            for charm_option, snap_option in self.SNAP_CONFIG_MAP.items():
-                err_msg = err_msg.replace(snap_option, charm_option)
+            err_msg = self._SNAP_OPTION_RE.sub(
+                lambda match: self._SNAP_TO_CHARM[match.group(0)], str(exc)
+            )
 
             logger.error(err_msg)
             self.unit.status = BlockedStatus("Invalid configuration. Please see logs.")
@@ -316,6 +503,11 @@ class PrometheusJujuExporterCharm(CharmBase):
         self.reconfigure_scrape_target()
         self.reconfigure_open_ports()
 
+    def _on_reload_dashboards(self, _: EventBase) -> None:
+        """Reload built-in grafana dashboards from the charm directory."""
+        # pylint: disable=protected-access
+        self.grafana_dashboard_provider._reinitialize_dashboard_data(inject_dropdowns=False)
+
     def _on_prometheus_available(self, _: PrometheusConnected) -> None:
         """Trigger configuration of a prometheus scrape target."""
         self.reconfigure_scrape_target()
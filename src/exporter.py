@@ -6,20 +6,50 @@
 
 Module focused on handling operations related to prometheus-juju-exporter snap.
 """
+import hashlib
+import http.client
+import json
 import logging
 import os
+import socket
 import subprocess
-from typing import Any, Dict, List, NamedTuple, Optional, Union
+import time
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import yaml
 from charmhelpers.core import host as ch_host
 from charmhelpers.fetch import snap
-from packaging import version
+
+if TYPE_CHECKING:
+    import packaging.version
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper, SafeLoader
 
 # Log messages can be retrieved using juju debug-log
 logger = logging.getLogger(__name__)
 
 
+# Structure of the exporter config file
+RenderedConfig = Dict[str, Union[Dict[str, Union[List[str], str, None]], str, None]]
+
+# Last version of the exporter that does not accept multiple controller endpoints
+_LAST_NON_HA_VERSION = "1.0.1"
+
+
+@lru_cache(maxsize=None)
+def _last_non_ha_version() -> "packaging.version.Version":
+    """Return parsed _LAST_NON_HA_VERSION."""
+    # Imported here to avoid import overhead in hooks that don't need it
+    from packaging import version  # pylint: disable=import-outside-toplevel
+
+    return version.Version(_LAST_NON_HA_VERSION)
+
+
 class ExporterConfigError(Exception):
     """Indicates problem with configuration of exporter service."""
 
@@ -40,8 +70,9 @@ class ExporterConfig(NamedTuple):
     password: Optional[str] = None
     interval: Optional[str] = None
     port: Optional[str] = None
-    prefixes: Optional[str] = None
+    prefixes: Tuple[str, ...] = ()
     match_interfaces: Optional[str] = None
+    installed_version: Optional["packaging.version.Version"] = None
 
     @property
     def controller_endpoint(self) -> Union[str, List[str]]:
@@ -49,14 +80,16 @@ class ExporterConfig(NamedTuple):
 
         Output is determined based on currently installed snap. Only
         prometheus-juju-exporter > 1.0.1 can accept list of strings in this config option.
+        Version of the installed snap is taken from 'installed_version' field. If it's not set,
+        the version is detected via ExporterSnap.version().
         """
         if self.controller is None or self.controller == "":
             return ""
 
         endpoints: Union[str, List[str]] = self.controller.split(",")
-        current_version = ExporterSnap.version()
+        current_version = self.installed_version or ExporterSnap.version()
 
-        if current_version <= version.Version("1.0.1"):
+        if current_version <= _last_non_ha_version():
             if len(endpoints) > 1:
                 raise ExporterConfigError(
                     f"Currently installed version of exporter ({current_version}) does "
@@ -66,7 +99,7 @@ class ExporterConfig(NamedTuple):
 
         return endpoints
 
-    def render(self) -> Dict[str, Union[Dict[str, Union[List[str], str, None]], str, None]]:
+    def render(self) -> RenderedConfig:
         """Return dict that can be written to an exporter config file as a yaml."""
         return {
             "debug": self.debug,
@@ -85,34 +118,56 @@ class ExporterConfig(NamedTuple):
                 "port": self.port,
             },
             "detection": {
-                "virt_macs": self.prefixes.split(",") if self.prefixes else [],
+                "virt_macs": list(self.prefixes),
                 "match_interfaces": self.match_interfaces or ".*",
             },
         }
 
 
+class _SnapdConnection(http.client.HTTPConnection):
+    """HTTP connection to snapd REST API that is served on a unix socket."""
+
+    def __init__(self, socket_path: str, timeout: float = 30) -> None:
+        """Initialize connection to snapd listening on :socket_path."""
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        """Connect to snapd unix socket."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
 class ExporterSnap:
     """Class that handles operations of prometheus-juju-exporter snap and related services."""
 
     SNAP_NAME = "prometheus-juju-exporter"
     SNAP_CONFIG_PATH = f"/var/snap/{SNAP_NAME}/current/config.yaml"
+    SNAP_CURRENT_PATH = f"/snap/{SNAP_NAME}/current"
+    SNAP_INSTALL_STATE_PATH = f"/var/snap/{SNAP_NAME}/common/.charm-install-state.json"
+    SNAPD_SOCKET_PATH = "/run/snapd.socket"
+    SNAPD_CHANGE_TIMEOUT = 120  # seconds
+    SNAPD_CHANGE_POLL_INTERVAL = 0.1  # seconds
+    _CONFIG_HEADER = "# content-version: {}\n"
+    # Locations of service's cgroup in unified (v2) and legacy (v1) cgroup hierarchy
+    _SERVICE_CGROUP_PATHS = (
+        "/sys/fs/cgroup/system.slice/{}/cgroup.procs",
+        "/sys/fs/cgroup/systemd/system.slice/{}/cgroup.procs",
+    )
     _SNAP_ACTIONS = [
         "stop",
         "start",
         "restart",
     ]
-    _REQUIRED_CONFIG = [
-        "customer.name",
-        "customer.cloud_name",
-        "juju.controller_endpoint",
-        "juju.controller_cacert",
-        "juju.username",
-        "juju.password",
-        "exporter.port",
-        "exporter.collect_interval",
-        "detection.virt_macs",
-        "detection.match_interfaces",
-    ]
+    # Required options grouped by config section in which they must be present
+    _REQUIRED_OPTIONS = (
+        ("customer", ("name", "cloud_name")),
+        ("juju", ("controller_endpoint", "controller_cacert", "username", "password")),
+        ("exporter", ("port", "collect_interval")),
+        ("detection", ("virt_macs", "match_interfaces")),
+    )
+    _cached_version: Optional["packaging.version.Version"] = None
 
     @property
     def service_name(self) -> str:
@@ -127,10 +182,25 @@ class ExporterSnap:
         This method tries to install snap from local file if parameter :snap_path is provided.
         Otherwise, it'll attempt installation from snap store based on ExporterSnap.SNAP_NAME.
 
+        Installation is skipped if the snap is already installed from the same source (same
+        channel or same local file) and its revision did not change since the last installation
+        performed by this charm.
+
         :param snap_path: Optional parameter to provide local file as source of snap installation.
         :raises:
             snap.CouldNotAcquireLockException: In case of snap installation failure.
         """
+        requested_state = {
+            "channel": None if snap_path else snap_channel,
+            "resource_sha256": self._file_sha256(snap_path) if snap_path else None,
+        }
+        revision = self._installed_revision()
+        if revision is not None and self._read_install_state() == dict(
+            requested_state, revision=revision
+        ):
+            logger.info("Snap %s is already installed from requested source.", self.SNAP_NAME)
+            return
+
         if snap_path:
             logger.info("Installing snap %s from local resource.", self.SNAP_NAME)
             snap.snap_install(snap_path, "--dangerous")
@@ -138,34 +208,71 @@ class ExporterSnap:
             logger.info("Installing %s snap from snap store.", self.SNAP_NAME)
             snap.snap_install(self.SNAP_NAME, "--channel", snap_channel)
 
+        self.invalidate_version_cache()
+        self._write_install_state(dict(requested_state, revision=self._installed_revision()))
+
+    def _installed_revision(self) -> Optional[str]:
+        """Return revision of currently installed snap or None if the snap is not installed."""
+        try:
+            return os.readlink(self.SNAP_CURRENT_PATH)
+        except OSError:
+            return None
+
+    def _read_install_state(self) -> Optional[Dict[str, Optional[str]]]:
+        """Return install state recorded by the last snap installation, if there's any."""
+        try:
+            with open(self.SNAP_INSTALL_STATE_PATH, "r", encoding="utf-8") as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_install_state(self, state: Dict[str, Optional[str]]) -> None:
+        """Record install state of the snap so that repeated installations can be skipped."""
+        try:
+            with open(self.SNAP_INSTALL_STATE_PATH, "w", encoding="utf-8") as state_file:
+                json.dump(state, state_file)
+        except OSError as exc:
+            logger.warning("Failed to record %s install state: %s", self.SNAP_NAME, exc)
+
+    @staticmethod
+    def _file_sha256(path: str) -> str:
+        """Return sha256 digest of a file."""
+        digest = hashlib.sha256()
+        with open(path, "rb") as file_:
+            for chunk in iter(lambda: file_.read(65536), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
     def uninstall(self) -> None:
         """Remove prometheus-juju-exporter snap."""
         snap.snap_remove(self.SNAP_NAME)
+        self.invalidate_version_cache()
 
     def _validate_required_options(self, config: Dict[str, Any]) -> List[str]:
         """Validate that config has all required options for snap to run."""
-        missing_options = []
-        for option in self._REQUIRED_CONFIG:
-            config_value = config
-            for identifier in option.split("."):
-                config_value = config_value.get(identifier, {})
-            if not config_value:
-                missing_options.append(option)
+        missing_options: List[str] = []
+        for section, options in self._REQUIRED_OPTIONS:
+            section_config = config.get(section)
+            if not isinstance(section_config, dict):
+                section_config = {}
+            missing_options.extend(
+                f"{section}.{option}" for option in options if not section_config.get(option)
+            )
 
         return missing_options
 
     @staticmethod
-    def _validate_option_values(config: Dict[str, Any]) -> str:
+    def _validate_option_values(config: Dict[str, Any]) -> List[str]:
         """Validate sane values for some of the config parameters where its feasible."""
-        errors = ""
+        errors = []
 
         # Verify that 'port' is number within valid port range.
         try:
             port = int(config["exporter"]["port"])
             if not 0 < port < 65535:
-                errors += f"Port {port} is not valid port number.{os.linesep}"
+                errors.append(f"Port {port} is not valid port number.")
         except ValueError:
-            errors += f"Configuration option 'port' must be a number.{os.linesep}"
+            errors.append("Configuration option 'port' must be a number.")
         except KeyError:
             pass  # Options was not in the config
 
@@ -173,12 +280,9 @@ class ExporterSnap:
         try:
             collect_interval = int(config["exporter"]["collect_interval"])
             if collect_interval < 1:
-                errors += (
-                    f"Configuration option 'collect_interval' must be a "
-                    f"positive number.{os.linesep}"
-                )
+                errors.append("Configuration option 'collect_interval' must be a positive number.")
         except ValueError:
-            errors += f"Configuration option 'collect_interval' must be a number.{os.linesep}"
+            errors.append("Configuration option 'collect_interval' must be a number.")
         except KeyError:
             pass  # Options was not in the config
 
@@ -192,46 +296,169 @@ class ExporterSnap:
             ExporterConfigError: In case the config does not pass the validation process. For
                 example if the required fields are missing or values have unexpected format.
         """
-        errors = ""
+        errors = []
 
         missing_options = self._validate_required_options(config)
         if missing_options:
             missing_str = ", ".join(missing_options)
-            errors += f"Following config options are missing: {missing_str}{os.linesep}"
+            errors.append(f"Following config options are missing: {missing_str}")
 
-        errors += self._validate_option_values(config)
+        errors.extend(self._validate_option_values(config))
 
         if errors:
-            raise ExporterConfigError(errors)
+            raise ExporterConfigError(os.linesep.join(errors))
 
     def apply_config(self, exporter_config: Dict[str, Any]) -> None:
-        """Update configuration file for exporter service."""
-        self.stop()
-        logger.info("Updating exporter service configuration.")
-        self.validate_config(exporter_config)
+        """Update configuration file for exporter service.
+
+        Service is restarted after the new configuration is written. If the configuration does
+        not pass the validation, the old config file is kept and the service is stopped.
 
-        with open(self.SNAP_CONFIG_PATH, "w", encoding="utf-8") as config_file:
-            yaml.safe_dump(exporter_config, config_file)
-        os.chmod(self.SNAP_CONFIG_PATH, 0o600)
+        The config file starts with a header that carries hash of its content. If the service is
+        running and the header matches hash of the new configuration, this method does nothing.
+        The header is removed if the service fails to restart with the new configuration.
+        """
+        rendered_config = yaml.dump(
+            exporter_config, Dumper=SafeDumper, default_flow_style=False, encoding="utf-8"
+        )
+        config_hash = hashlib.blake2b(rendered_config, digest_size=16).hexdigest()
+        header = self._CONFIG_HEADER.format(config_hash).encode("utf-8")
+        if self._read_config_header() == header and self.is_running():
+            logger.info("Exporter configuration did not change.")
+            return
+
+        logger.info("Updating exporter service configuration.")
+        try:
+            self.validate_config(exporter_config)
+        except ExporterConfigError:
+            self.stop()
+            raise
 
-        self.restart()
+        self._write_config(header + rendered_config)
+        try:
+            self.restart()
+        except ExporterSnapError:
+            # Drop the header, so that the config is re-applied even if the old process runs
+            self._write_config(rendered_config)
+            raise
         logger.info("Exporter configuration updated.")
 
+    def _write_config(self, content: bytes) -> None:
+        """Write content to a temporary file and atomically replace the exporter config with it."""
+        tmp_path = f"{self.SNAP_CONFIG_PATH}.tmp"
+        config_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(config_fd, "wb") as config_file:
+                # mode passed to os.open applies only if the file is created, not to leftovers
+                os.fchmod(config_file.fileno(), 0o600)
+                config_file.write(content)
+                config_file.flush()
+                os.fsync(config_file.fileno())
+            os.replace(tmp_path, self.SNAP_CONFIG_PATH)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def _read_config_header(self) -> bytes:
+        """Return first line of the current exporter config file."""
+        try:
+            with open(self.SNAP_CONFIG_PATH, "rb") as config_file:
+                return config_file.readline()
+        except OSError:
+            return b""
+
+    @classmethod
+    def version(cls) -> "packaging.version.Version":
+        """Return version of currently installed exporter.
+
+        Version is queried from snapd REST API, with 'snap info' command used as a fallback if
+        the API is not available. Version is detected only once and then cached until the snap
+        is (re)installed or removed by this class.
+        """
+        if cls._cached_version is not None:
+            return cls._cached_version
+
+        from packaging import version  # pylint: disable=import-outside-toplevel
+
+        snap_version = cls._snapd_version() or cls._cli_version()
+        cls._cached_version = version.Version(snap_version)
+        return cls._cached_version
+
     @classmethod
-    def version(cls) -> version.Version:
-        """Return version of currently installed exporter."""
+    def _snapd_request(
+        cls, method: str, path: str, body: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Send request to snapd REST API and return decoded response document.
+
+        :param method: HTTP method of the request
+        :param path: API endpoint
+        :param body: Optional data sent as a JSON body of the request
+
+        :raises:
+            OSError: If snapd socket is not reachable.
+            http.client.HTTPException: If snapd does not respond with valid HTTP.
+            ValueError: If body of the snapd response is not valid JSON.
+        """
+        connection = _SnapdConnection(cls.SNAPD_SOCKET_PATH)
+        try:
+            if body is None:
+                connection.request(method, path)
+            else:
+                connection.request(
+                    method,
+                    path,
+                    body=json.dumps(body).encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
+                )
+            return json.loads(connection.getresponse().read())
+        finally:
+            connection.close()
+
+    @classmethod
+    def _snapd_version(cls) -> Optional[str]:
+        """Return version of installed snap as reported by snapd REST API.
+
+        None is returned if the API can't be used, in which case caller should fall
+        back to the snap CLI.
+
+        :raises:
+            ExporterSnapError: If snapd reports that the snap is not installed.
+        """
+        try:
+            response = cls._snapd_request("GET", f"/v2/snaps/{cls.SNAP_NAME}")
+        except (OSError, http.client.HTTPException, ValueError) as exc:
+            logger.debug("Failed to query snapd API: %s", exc)
+            return None
+
+        if response.get("status-code") == 404:
+            raise ExporterSnapError("Exporter snap is not installed.")
+
+        result = response.get("result")
+        if response.get("type") != "sync" or not isinstance(result, dict):
+            logger.debug("Unexpected response from snapd API: %s", response)
+            return None
+
+        return result.get("version")
+
+    @classmethod
+    def _cli_version(cls) -> str:
+        """Return version of installed snap as reported by 'snap info' command."""
         cmd = ["snap", "info", cls.SNAP_NAME]
         try:
             raw_output = subprocess.check_output(cmd)
-            snap_info = yaml.safe_load(raw_output)
+            snap_info = yaml.load(raw_output, Loader=SafeLoader)
         except (subprocess.CalledProcessError, yaml.YAMLError) as exc:
             raise ExporterSnapError(f"Failed to get exporter snap version: {exc}") from exc
 
         if "installed" not in snap_info:
             raise ExporterSnapError("Exporter snap is not installed.")
 
-        snap_version = snap_info["installed"].split()[0]
-        return version.Version(snap_version)
+        return snap_info["installed"].split()[0]
+
+    @classmethod
+    def invalidate_version_cache(cls) -> None:
+        """Drop cached version of the exporter so that it's detected again on next request."""
+        cls._cached_version = None
 
     def restart(self) -> None:
         """Restart exporter service."""
@@ -246,7 +473,20 @@ class ExporterSnap:
         self._execute_service_action("start")
 
     def is_running(self) -> bool:
-        """Check if exporter service is running."""
+        """Check if exporter service is running.
+
+        Service that has any process in its cgroup is considered running without spawning
+        any subprocess. If the cgroup is empty or can't be found, the check falls back to
+        querying systemd.
+        """
+        for cgroup_path in self._SERVICE_CGROUP_PATHS:
+            try:
+                with open(cgroup_path.format(self.service_name), "rb") as procs_file:
+                    if procs_file.read(1):
+                        return True
+            except OSError:
+                continue
+
         return ch_host.service_running(self.service_name)
 
     def _execute_service_action(self, action: str) -> None:
@@ -260,8 +500,93 @@ class ExporterSnap:
         :param action: snap service action to execute
         :raises:
             RuntimeError: If requested action is not supported.
+            ExporterSnapError: If the action fails.
         """
         if action not in self._SNAP_ACTIONS:
             raise RuntimeError(f"Snap service action '{action}' is not supported.")
         logger.info("%s service executing action: %s", self.SNAP_NAME, action)
-        subprocess.call(["snap", action, self.SNAP_NAME])
+        if not self._snapd_service_action(action):
+            self._cli_service_action(action)
+
+    def _snapd_service_action(self, action: str) -> bool:
+        """Execute snap service action via snapd REST API and wait for it to finish.
+
+        :param action: snap service action to execute
+        :return: False if the API can't be used, in which case caller should fall back to the
+            snap CLI. True if the action was successfully executed.
+        :raises:
+            ExporterSnapError: If snapd fails to execute the action.
+        """
+        try:
+            response = self._snapd_request(
+                "POST", "/v2/apps", {"action": action, "names": [self.SNAP_NAME]}
+            )
+        except (OSError, http.client.HTTPException, ValueError) as exc:
+            logger.debug("Failed to query snapd API: %s", exc)
+            return False
+
+        if response.get("type") != "async":
+            result = response.get("result") or {}
+            raise ExporterSnapError(
+                f"Failed to {action} {self.SNAP_NAME} service: {result.get('message')}"
+            )
+
+        result = self._wait_for_snapd_change(response["change"], action)
+        if result.get("status") != "Done":
+            raise ExporterSnapError(
+                f"Failed to {action} {self.SNAP_NAME} service: {result.get('err')}"
+            )
+
+        return True
+
+    def _wait_for_snapd_change(self, change_id: str, action: str) -> Dict[str, Any]:
+        """Poll snapd REST API until the change is ready and return its result.
+
+        :param change_id: ID of the snapd change that executes the action
+        :param action: snap service action executed by the change, used in error messages
+        :raises:
+            ExporterSnapError: If snapd can't report status of the change or the change does
+                not finish in time.
+        """
+        deadline = time.monotonic() + self.SNAPD_CHANGE_TIMEOUT
+        while True:
+            try:
+                change = self._snapd_request("GET", f"/v2/changes/{change_id}")
+            except (OSError, http.client.HTTPException, ValueError) as exc:
+                raise ExporterSnapError(
+                    f"Failed to get status of {self.SNAP_NAME} service {action}: {exc}"
+                ) from exc
+
+            result = change.get("result") or {}
+            if change.get("type") == "error":
+                raise ExporterSnapError(
+                    f"Failed to get status of {self.SNAP_NAME} service {action}: "
+                    f"{result.get('message')}"
+                )
+            if result.get("ready"):
+                return result
+            if time.monotonic() > deadline:
+                raise ExporterSnapError(
+                    f"Timed out waiting for {self.SNAP_NAME} service {action}."
+                )
+            time.sleep(self.SNAPD_CHANGE_POLL_INTERVAL)
+
+    def _cli_service_action(self, action: str) -> None:
+        """Execute snap service action via snap CLI.
+
+        :param action: snap service action to execute
+        :raises:
+            ExporterSnapError: If the action fails.
+        """
+        try:
+            subprocess.run(
+                ["snap", action, self.SNAP_NAME],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+        except subprocess.CalledProcessError as exc:
+            error = exc.stderr.decode(errors="replace").strip()
+            raise ExporterSnapError(
+                f"Failed to {action} {self.SNAP_NAME} service: {error}"
+            ) from exc
@@ -3,26 +3,23 @@
 # See LICENSE file for licensing details.
 """Pre-test configuration of a prometheus-juju-exporter testing model."""
 
+import json
 import logging
 from base64 import b64encode
-from pathlib import Path
 
-import yaml
 from zaza import model
 
 from .test_charm import wait_for_model_settle
 
 logger = logging.getLogger(__name__)
 
-JUJU_LOCAL_DATA = Path("/home/ubuntu/.local/share/juju/")
-ACCOUNT_FILE = JUJU_LOCAL_DATA.joinpath("accounts.yaml")
-CONTROLLER_FILE = JUJU_LOCAL_DATA.joinpath("controllers.yaml")
+CONTROLLER_NAME = "lxd"
 
 
 def setup_juju_credentials() -> None:
     """Configure prometheus-juju-exporter with required juju credentials.
 
-    Credentials are pulled form config files of a nested controller deployed by
+    Credentials are pulled form the client of a nested controller deployed by
     'juju-local' charm during the tests.
     """
     controller_units = model.get_units("juju-local")
@@ -31,31 +28,24 @@ def setup_juju_credentials() -> None:
         logger.error(err)
         raise RuntimeError(err)
 
-    # Get juju controller credentials
+    # Get juju controller credentials and endpoint details
     juju_controller = controller_units[0].entity_id
-    account_data = model.run_on_unit(juju_controller, f"cat {ACCOUNT_FILE}")
+    controller_data = model.run_on_unit(
+        juju_controller,
+        f"sudo -u ubuntu juju show-controller {CONTROLLER_NAME} --show-password --format=json",
+    )
     try:
-        accounts = yaml.safe_load(account_data["Stdout"])
-        username = accounts["controllers"]["lxd"]["user"]
-        password = accounts["controllers"]["lxd"]["password"]
-    except KeyError as exc:
+        controller = json.loads(controller_data["Stdout"])[CONTROLLER_NAME]
+        username = controller["account"]["user"]
+        password = controller["account"]["password"]
+        endpoint = controller["details"]["api-endpoints"][0]
+        ca_cert = str(controller["details"]["ca-cert"])
+    except (KeyError, ValueError) as exc:
         logger.error(
             "Failed to parse juju credentials for controller deployed by 'juju-local' charm"
         )
         raise exc
 
-    # Get juju controller endpoint details
-    controller_data = model.run_on_unit(juju_controller, f"cat {CONTROLLER_FILE}")
-    try:
-        controllers = yaml.safe_load(controller_data["Stdout"])
-        endpoint = controllers["controllers"]["lxd"]["api-endpoints"][0]
-        ca_cert = str(controllers["controllers"]["lxd"]["ca-cert"])
-    except KeyError as exc:
-        logger.error(
-            "Failed to parse juju endpoint for controller deployed by 'juju-local' charm."
-        )
-        raise exc
-
     # configure juju exporter
     model.set_application_config(
         "prometheus-juju-exporter",
@@ -5,16 +5,20 @@
 
 import logging
 import os
+import re
+import time
 import unittest
 from typing import Dict
 
 import juju.unit
-import tenacity
 import urllib3
 from zaza import model
 
 logger = logging.getLogger(__name__)
 
+# Metric lines reporting machine in UP state
+_MACHINE_UP_RE = re.compile(rb"^juju_machine_state\{.*1\.0$", re.MULTILINE)
+
 
 def wait_for_model_settle() -> None:
     """Wait for specific unit states that indicate settled model."""
@@ -34,10 +38,23 @@ class BasicPrometheusJujuExporterTests(unittest.TestCase):
 
     NAME = "prometheus-juju-exporter"
     CONTROLLER_APP = "juju-local"  # name of the application that deploys nested Juju controller.
+    VALIDATION_ATTEMPTS = 24
+    VALIDATION_WAIT = 5  # seconds between exporter validation attempts
+
+    http: urllib3.PoolManager
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """Configure resources shared by all tests."""
+        cls.http = urllib3.PoolManager(num_pools=4, maxsize=8)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Release resources shared by all tests."""
+        cls.http.clear()
 
     def setUp(self) -> None:
         """Configure resource before tests."""
-        self.http = urllib3.PoolManager()
         self.unit = self.get_application_unit(self.NAME)
         self.controller = self.get_application_unit(self.CONTROLLER_APP)
 
@@ -113,19 +130,26 @@ class BasicPrometheusJujuExporterTests(unittest.TestCase):
             f"juju destroy-model --no-prompt {model_name} --force --destroy-storage --timeout 10m",
         )
 
-    @tenacity.retry(
-        wait=tenacity.wait_fixed(5),
-        stop=tenacity.stop_after_attempt(24),
-    )
     def validate_exporter(self, expected_machine_count: int = 1) -> None:
         """Verify that exporter exposes expected data on '/metrics' endpoint.
 
-        This method is often called after config changes and therefore has grace period of 60
+        This method is often called after config changes and therefore has grace period of 120
         seconds to reach expected result as the exporter service may still be restarting/settling.
 
         :param expected_machine_count: How many machines are expected to be in UP state
         """
-        machine_count = 0
+        for attempt in range(1, self.VALIDATION_ATTEMPTS + 1):
+            try:
+                self._check_exporter_metrics(expected_machine_count)
+                return
+            except (AssertionError, urllib3.exceptions.HTTPError) as exc:
+                if attempt == self.VALIDATION_ATTEMPTS:
+                    raise
+                logger.debug("Exporter validation attempt %s failed: %s", attempt, exc)
+                time.sleep(self.VALIDATION_WAIT)
+
+    def _check_exporter_metrics(self, expected_machine_count: int) -> None:
+        """Perform single check of data exposed by the exporter on '/metrics' endpoint."""
         unit_ip = self.unit.public_address
         scrape_port = self.get_config_value("scrape-port")
         endpoint = f"http://{unit_ip}:{scrape_port}/metrics"
@@ -136,10 +160,7 @@ class BasicPrometheusJujuExporterTests(unittest.TestCase):
             )
             self.fail("Failed to reach exporter endpoint.")
 
-        for line in response.data.decode("utf-8").splitlines():
-            if line.startswith("juju_machine_state{") and line.endswith("1.0"):
-                machine_count += 1
-
+        machine_count = len(_MACHINE_UP_RE.findall(response.data))
         self.assertEqual(
             machine_count,
             expected_machine_count,
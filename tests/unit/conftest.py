@@ -4,12 +4,17 @@
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 """Fixture for charm's unit tests."""
 from typing import Dict
+from unittest import mock
 
 import ops.testing
 import pytest
+import yaml
 
+import exporter
 from charm import PrometheusJujuExporterCharm, PrometheusScrapeTarget
 
+ops.testing.SIMULATE_CAN_CONNECT = True
+
 
 @pytest.fixture(scope="session")
 def unit_hostname() -> str:
@@ -17,18 +22,37 @@ def unit_hostname() -> str:
     return "10.0.0.1"
 
 
+@pytest.fixture(scope="session", autouse=True)
+def mocked_hostname(unit_hostname) -> mock.MagicMock:
+    """Make PrometheusScrapeTarget report statically defined hostname for the whole session."""
+    with mock.patch.object(
+        PrometheusScrapeTarget, "get_hostname", return_value=unit_hostname
+    ) as get_hostname:
+        yield get_hostname
+
+
 @pytest.fixture()
-def harness(unit_hostname, mocker) -> ops.testing.Harness[PrometheusJujuExporterCharm]:
+def harness() -> ops.testing.Harness[PrometheusJujuExporterCharm]:
     """Return harness for PrometheusJujuExporterCharm."""
-    ops.testing.SIMULATE_CAN_CONNECT = True
-    mocker.patch.object(PrometheusScrapeTarget, "get_hostname", return_value=unit_hostname)
-
     harness = ops.testing.Harness(PrometheusJujuExporterCharm)
     harness.begin()
     yield harness
 
     harness.cleanup()
-    ops.testing.SIMULATE_CAN_CONNECT = False
+
+
+@pytest.fixture()
+def configured_harness(harness) -> ops.testing.Harness[PrometheusJujuExporterCharm]:
+    """Return harness with disabled hooks, so that config can be updated without side effects."""
+    with harness.hooks_disabled():
+        yield harness
+
+
+@pytest.fixture(autouse=True)
+def clear_version_cache() -> None:
+    """Drop exporter version cached by ExporterSnap so that it does not leak between tests."""
+    yield
+    exporter.ExporterSnap.invalidate_version_cache()
 
 
 @pytest.fixture(scope="session")
@@ -39,3 +63,21 @@ def snap_info_1_0_1() -> Dict:
         "summary": "collects and exports juju machine status",
         "installed": "1.0.1            (31) 20MB -",
     }
+
+
+@pytest.fixture(scope="session")
+def snap_info_1_0_1_yaml(snap_info_1_0_1) -> str:
+    """Sample output of 'snap info' command for exporter snap v1.0.1, serialized as YAML."""
+    return yaml.dump(snap_info_1_0_1)
+
+
+@pytest.fixture(scope="session")
+def snap_info_not_installed_yaml(snap_info_1_0_1) -> str:
+    """Sample output of 'snap info' command for exporter snap that is not installed."""
+    return yaml.dump({key: value for key, value in snap_info_1_0_1.items() if key != "installed"})
+
+
+@pytest.fixture(scope="module")
+def exporter_snap() -> exporter.ExporterSnap:
+    """Return ExporterSnap instance shared by tests in the module."""
+    return exporter.ExporterSnap()
@@ -3,9 +3,10 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 """Unit tests for PrometheusJujuExporterCharm."""
+import io
 import pathlib
 from base64 import b64decode
-from itertools import repeat
+from typing import Callable
 from unittest import mock
 
 import pytest
@@ -16,29 +17,89 @@ from packaging import version
 import charm
 import exporter
 
-
-@pytest.mark.parametrize(
-    "event_name, handler",
-    [
+_CHARM_PATH = "/var/lib/juju/agents/unit-0/charm/"
+_EXPECTED_AGENT_CONF_PATH = pathlib.Path(_CHARM_PATH).joinpath("../agent.conf")
+
+# Fake agent.conf payloads
+_CONTROLLER_VERSION = "2.9.42.2"
+_CONTROLLER_CA_CERT = "CA DATA"
+_CONTROLLER_V2_9 = version.parse(_CONTROLLER_VERSION)
+_EXPORTER_V1_0_2 = version.parse("1.0.2")
+_AGENT_CONF_EMPTY = "{}\n"
+_AGENT_CONF_WITH_VERSION = f"upgradedToVersion: {_CONTROLLER_VERSION}\n"
+_AGENT_CONF_WITH_CA_CERT = f"cacert: {_CONTROLLER_CA_CERT}\n"
+_AGENT_CONF_COMPLETE = _AGENT_CONF_WITH_CA_CERT + _AGENT_CONF_WITH_VERSION
+
+# Values of 'controller-ca-cert' config option
+_VALID_CA_B64 = "VGhpcyBpcyB2YWxpZCBDQQ=="
+_VALID_CA_EXPECTED = b64decode(_VALID_CA_B64).decode(encoding="ascii")
+_INVALID_CA_B64 = "this_is-not valid b64"
+
+# Expected exporter snap channels for supported controller versions
+_SNAP_CHANNELS = {
+    version.parse("2.6.5"): "2.8/stable",
+    version.parse("2.7.6"): "2.8/stable",
+    version.parse("2.8.8"): "2.8/stable",
+    _CONTROLLER_V2_9: "2.9/stable",
+    version.parse("3.1.5"): "3/stable",
+    version.parse("3.2.5"): "3/stable",
+    version.parse("3.3.4"): "3/stable",
+    version.parse("3.4.1"): "3/stable",
+    version.parse("3.6.0"): "3/stable",
+}
+
+
+def _fake_open(content: str) -> Callable[..., io.StringIO]:
+    """Return side effect for patched 'open' that serves :content as a text file."""
+    return lambda *_, **__: io.StringIO(content)
+
+
+def test_charm_event_mapping(harness):
+    """Test that all events are bound to the expected event handlers."""
+    event_handlers = [
         ("on.config_changed", "_on_config_changed"),
         ("on.install", "_on_install"),
         ("prometheus_target.on.prometheus_available", "_on_prometheus_available"),
         ("on.upgrade_charm", "_on_upgrade_charm"),
         ("on.update_status", "_on_update_status"),
         ("on.stop", "_on_stop"),
-    ],
-)
-def test_charm_event_mapping(event_name, handler, harness, mocker):
-    """Test that all events are bound to the expected event handlers."""
-    mocked_handler = mocker.patch.object(harness.charm, handler)
+    ]
+
+    for event_name, handler in event_handlers:
+        event = harness.charm
+        for object_ in event_name.split("."):
+            event = getattr(event, object_)
+
+        with mock.patch.object(harness.charm, handler) as mocked_handler:
+            event.emit()
+
+        mocked_handler.assert_called_once()
 
-    event = harness.charm
-    for object_ in event_name.split("."):
-        event = getattr(event, object_)
 
-    event.emit()
+@pytest.mark.parametrize("event_name", ["install", "upgrade_charm", "leader_elected"])
+def test_dashboards_reload_event_mapping(event_name, harness, mocker):
+    """Test that built-in dashboards are reloaded only on selected events."""
+    mocker.patch.object(harness.charm, "_on_install")
+    mocker.patch.object(harness.charm, "_on_upgrade_charm")
+    reload_mock = mocker.patch.object(
+        harness.charm.grafana_dashboard_provider, "_reinitialize_dashboard_data"
+    )
+
+    getattr(harness.charm.on, event_name).emit()
+
+    reload_mock.assert_called_once_with(inject_dropdowns=False)
+
+
+def test_dashboards_not_reloaded_on_other_events(harness, mocker):
+    """Test that built-in dashboards are not re-read on unrelated hooks."""
+    mocker.patch.object(harness.charm, "_on_update_status")
+    reload_mock = mocker.patch.object(
+        harness.charm.grafana_dashboard_provider, "_reinitialize_dashboard_data"
+    )
+
+    harness.charm.on.update_status.emit()
 
-    mocked_handler.assert_called_once()
+    reload_mock.assert_not_called()
 
 
 @pytest.mark.parametrize(
@@ -57,7 +118,7 @@ def test_snap_path_property(resource_exists, resource_size, is_path_expected, ha
     snap_name = "exporter-snap"
     if resource_exists:
         # Generate some fake data for snap file if it's supposed to have some
-        snap_data = "".join(list(repeat("0", resource_size)))
+        snap_data = "0" * resource_size
         harness.add_resource(snap_name, snap_data)
 
     expected_path = (
@@ -70,38 +131,49 @@ def test_snap_path_property(resource_exists, resource_size, is_path_expected, ha
 @pytest.mark.parametrize(
     "controller_version, channel",
     [
-        ("2.6.5", "2.8/stable"),  # In case controller version is 2.6.x, return 2.8/stable
-        ("2.7.6", "2.8/stable"),  # In case controller version is 2.7.x, return 2.8/stable
-        ("2.8.8", "2.8/stable"),  # In case controller version is 2.8.x, return 2.8/stable
-        ("2.9.42.2", "2.9/stable"),  # In case controller version is 2.9.x, return 2.9/stable
-        ("3.1.5", "3/stable"),  # In case controller version is 3.1.5, return 3/stable
-        ("3.2.5", "3/stable"),  # In case controller version is 3.2.5, return 3/stable
-        ("3.3.4", "3/stable"),  # In case controller version is 3.3.4, return 3/stable
-        ("3.4.1", "3/stable"),  # In case controller version is 3.4.1, return 3/stable
-        ("3.6.0", "3/stable"),  # In case controller version is 3.6.0, return 3/stable
+        (version.parse("2.6.5"), "2.8/stable"),  # 2.6-2.8 controller, return 2.8/stable
+        (_CONTROLLER_V2_9, "2.9/stable"),  # 2.9.x controller, return 2.9/stable
+        (version.parse("3.1.5"), "3/stable"),  # 3.x controller, return 3/stable
     ],
 )
 def test_snap_channel_property(controller_version, channel, harness, mocker):
     """Test that 'snap_channel' property returns the correct channel."""
-    mocker.patch.object(
-        harness.charm, "get_controller_version", return_value=version.parse(controller_version)
-    )
+    mocker.patch.object(harness.charm, "get_controller_version", return_value=controller_version)
 
     assert harness.charm.snap_channel == channel
 
 
+def test_snap_channel_property_all_versions(harness, mocker):
+    """Test 'snap_channel' property for all supported controller versions."""
+    mock_version = mocker.patch.object(harness.charm, "get_controller_version")
+
+    for controller_version, channel in _SNAP_CHANNELS.items():
+        harness.charm._snap_channel = None
+        mock_version.return_value = controller_version
+
+        assert harness.charm.snap_channel == channel, f"controller {controller_version}"
+
+
+def test_snap_channel_property_cached(harness, mocker):
+    """Test that 'snap_channel' evaluates controller version only once."""
+    mock_version = mocker.patch.object(
+        harness.charm, "get_controller_version", return_value=_CONTROLLER_V2_9
+    )
+
+    assert harness.charm.snap_channel == harness.charm.snap_channel
+    mock_version.assert_called_once_with()
+
+
 @pytest.mark.parametrize(
     "controller_version",
     [
-        "2.5.5",  # Controller version too low
-        "4.0.1",  # Controller version too high
+        version.parse("2.5.5"),  # Controller version too low
+        version.parse("4.0.1"),  # Controller version too high
     ],
 )
 def test_snap_channel_property_incompatible_controller(controller_version, harness, mocker):
     """Test that 'snap_channel' property raises exception for incompatible controller version."""
-    mocker.patch.object(
-        harness.charm, "get_controller_version", return_value=version.parse(controller_version)
-    )
+    mocker.patch.object(harness.charm, "get_controller_version", return_value=controller_version)
 
     with pytest.raises(charm.ControllerIncompatibleError):
         harness.charm.snap_channel
@@ -109,87 +181,162 @@ def test_snap_channel_property_incompatible_controller(controller_version, harne
 
 def test_get_controller_version_success(harness, mocker):
     """Test successfully parsing controller version data out of an agent.conf file."""
-    charm_path = "/var/lib/juju/agents/unit-0/charm/"
-    agent_config_path = pathlib.Path(charm_path).joinpath("../agent.conf")
-    agent_conf_data = {"upgradedToVersion": "2.9.42.2"}
-    agent_conf_content = yaml.safe_dump(agent_conf_data, indent=2)
-    mocker.patch.object(charm.hookenv, "charm_dir", return_value=charm_path)
-
-    with mock.patch("builtins.open", mock.mock_open(read_data=agent_conf_content)) as open_mock:
-        expected_controller_version = version.parse(agent_conf_data["upgradedToVersion"])
+    mocker.patch.object(charm.hookenv, "charm_dir", return_value=_CHARM_PATH)
+    mocker.patch.object(charm.os, "stat")
+
+    with mock.patch(
+        "builtins.open", side_effect=_fake_open(_AGENT_CONF_WITH_VERSION)
+    ) as open_mock:
+        expected_controller_version = _CONTROLLER_V2_9
         controller_version = harness.charm.get_controller_version()
         assert controller_version == expected_controller_version
+        assert harness.charm.get_controller_version() is controller_version
 
-    open_mock.assert_called_once_with(agent_config_path, "r", encoding="utf-8")
+    open_mock.assert_called_once_with(_EXPECTED_AGENT_CONF_PATH, "r", encoding="utf-8")
 
 
 def test_get_controller_version_fail(harness, mocker):
     """Test failure when controller version can't be parsed out of an agent.conf file."""
-    charm_path = "/var/lib/juju/agents/unit-0/charm/"
-    agent_config_path = pathlib.Path(charm_path).joinpath("../agent.conf")
-    agent_conf_data = {}
-    agent_conf_content = yaml.safe_dump(agent_conf_data, indent=2)
-    mocker.patch.object(charm.hookenv, "charm_dir", return_value=charm_path)
+    mocker.patch.object(charm.hookenv, "charm_dir", return_value=_CHARM_PATH)
+    mocker.patch.object(charm.os, "stat")
 
-    with mock.patch("builtins.open", mock.mock_open(read_data=agent_conf_content)) as open_mock:
+    with mock.patch("builtins.open", side_effect=_fake_open(_AGENT_CONF_EMPTY)) as open_mock:
         with pytest.raises(RuntimeError):
             harness.charm.get_controller_version()
 
-    open_mock.assert_called_once_with(agent_config_path, "r", encoding="utf-8")
+    open_mock.assert_called_once_with(_EXPECTED_AGENT_CONF_PATH, "r", encoding="utf-8")
 
 
-def test_get_controller_ca_cert_from_file_success(harness, mocker):
-    """Test successfully parsing CA cert data out of an agent.conf file."""
-    charm_path = "/var/lib/juju/agents/unit-0/charm/"
-    agent_config_path = pathlib.Path(charm_path).joinpath("../agent.conf")
-    agent_conf_data = {"cacert": "CA DATA"}
-    agent_conf_content = yaml.safe_dump(agent_conf_data, indent=2)
-    mocker.patch.object(charm.hookenv, "charm_dir", return_value=charm_path)
+@pytest.mark.parametrize(
+    "source, payload, expected_ca_cert",
+    [
+        ("file", _AGENT_CONF_WITH_CA_CERT, _CONTROLLER_CA_CERT),
+        ("file", _AGENT_CONF_EMPTY, None),  # no CA cert in agent.conf
+        ("config", _VALID_CA_B64, _VALID_CA_EXPECTED),
+        ("config", _INVALID_CA_B64, None),  # config option is not valid base64
+    ],
+    ids=["file-success", "file-fail", "config-success", "config-fail"],
+)
+def test_get_controller_ca_cert(source, payload, expected_ca_cert, harness, mocker):
+    """Test getting CA cert from agent.conf file or from 'controller-ca-cert' config option.
 
-    with mock.patch("builtins.open", mock.mock_open(read_data=agent_conf_content)) as open_mock:
-        expected_ca_cert = agent_conf_data["cacert"]
-        ca_cert = harness.charm.get_controller_ca_cert()
-        assert ca_cert == expected_ca_cert
+    Value None in 'expected_ca_cert' means that the CA cert can't be obtained.
+    """
+    mocker.patch.object(charm.hookenv, "charm_dir", return_value=_CHARM_PATH)
+    mocker.patch.object(charm.os, "stat")
+    agent_conf_content = payload if source == "file" else _AGENT_CONF_EMPTY
+    if source == "config":
+        with harness.hooks_disabled():
+            harness.update_config({"controller-ca-cert": payload})
+
+    with mock.patch("builtins.open", side_effect=_fake_open(agent_conf_content)) as open_mock:
+        if expected_ca_cert is None:
+            with pytest.raises(RuntimeError):
+                harness.charm.get_controller_ca_cert()
+        else:
+            assert harness.charm.get_controller_ca_cert() == expected_ca_cert
+
+    if source == "file":
+        open_mock.assert_called_once_with(_EXPECTED_AGENT_CONF_PATH, "r", encoding="utf-8")
+    else:
+        open_mock.assert_not_called()
 
-    open_mock.assert_called_once_with(agent_config_path, "r", encoding="utf-8")
 
+@pytest.mark.parametrize(
+    "content, expected_fields",
+    [
+        (
+            "cacert: CA DATA\nupgradedToVersion: 2.9.42.2\n",
+            {"cacert": "CA DATA", "upgradedToVersion": "2.9.42.2"},
+        ),
+        (
+            "cacert: |\n  CA\n  DATA\nupgradedToVersion: 3.1.5\n",
+            {"cacert": "CA\nDATA\n", "upgradedToVersion": "3.1.5"},
+        ),
+        ("cacert: |-\n  CA\n  DATA", {"cacert": "CA\nDATA"}),
+        ("cacert: |-\n  CA\n  DATA\n", {"cacert": "CA\nDATA"}),
+        ("cacert: |\n  CA\n  DATA", {"cacert": "CA\nDATA"}),  # no line break at EOF
+        ("cacert: |\n  CA\n    DATA\n# comment\n", {"cacert": "CA\n  DATA\n"}),
+        ("values:\n  cacert: CA DATA\nother: 1\n", {}),
+        ("# comment\n\ncacert: CA DATA\n\nother: |\n  a: b\n", {"cacert": "CA DATA"}),
+        ("cacert: CA DATA\n\n  MORE\n", None),  # plain scalar continued after blank line
+        ("cacert: CA DATA\n# comment\n  MORE\n", None),  # plain scalar continued after comment
+        ("cacert: a: b\n", None),  # invalid plain scalar
+        ("cacert: CA #DATA\n", None),  # comment
+        ("cacert: CA\u00e9\n", None),  # non-ASCII character
+        ("cacert: |\n  CA\ncacert: |\n DATA\n", {"cacert": "DATA\n"}),
+        ("cacert: |\n\ncacert: CA\n", None),  # blank line in block scalar
+        ("cacert: |\nother: 1\n", None),  # empty block scalar
+        ("cacert: |\n    CA\n  DATA\ncacert: CA\n", None),  # irregular indentation
+        ("apiaddresses:\n- 10.0.0.1:17070\n-\ncacert: CA\n", {"cacert": "CA"}),
+        ("cacert: CA\n- DATA\n", None),  # sequence item after requested key
+        ("cacert: |\n  CA\n# comment\n  DATA\n", None),  # block scalar continued after comment
+        ("  cacert: CA\n", None),  # indented top-level content
+        ('"cacert": CA\n', None),  # quoted key
+        ("{cacert: CA}\n", None),  # flow mapping
+        ("cacert: 'CA DATA'\n", None),  # quoted scalar
+        ("cacert: >\n  CA\n  DATA\n", None),  # folded block scalar
+        ("cacert: CA\n  DATA\n", None),  # multi-line plain scalar
+        ("cacert: |\n    CA\n  DATA\n", None),  # irregular indentation
+        ("cacert: |\n  CA\n\n  DATA\n", None),  # blank line in block scalar
+        ("cacert:\n", None),  # empty value
+        ("cacert: null\n", None),  # null
+        ("cacert: ~\n", None),  # null
+        ("cacert: yes\n", None),  # bool
+        ("cacert: 17\n", None),  # int
+        ("upgradedToVersion: 3.1\n", None),  # float
+        ("upgradedToVersion: 2023-01-01\n", None),  # timestamp
+        ("cacert: |\n\tCA\n", None),  # block scalar indented by tab
+        ("cacert: |\n  CA\n\tDATA\n", None),  # tab after block scalar
+    ],
+)
+def test_read_agent_conf_fields(content, expected_fields):
+    """Test reading selected fields from agent.conf without full YAML parser."""
+    fields = charm._read_agent_conf_fields(io.StringIO(content), ["cacert", "upgradedToVersion"])
 
-def test_get_controller_ca_cert_from_file_fail(harness, mocker):
-    """Test failure when CA cert can't be parsed out of an agent.conf file."""
-    charm_path = "/var/lib/juju/agents/unit-0/charm/"
-    agent_config_path = pathlib.Path(charm_path).joinpath("../agent.conf")
-    agent_conf_data = {}
-    agent_conf_content = yaml.safe_dump(agent_conf_data, indent=2)
-    mocker.patch.object(charm.hookenv, "charm_dir", return_value=charm_path)
+    assert fields == expected_fields
+    if fields is not None:
+        assert fields == {key: yaml.safe_load(content)[key] for key in fields}
 
-    with mock.patch("builtins.open", mock.mock_open(read_data=agent_conf_content)) as open_mock:
-        with pytest.raises(RuntimeError):
-            harness.charm.get_controller_ca_cert()
 
-    open_mock.assert_called_once_with(agent_config_path, "r", encoding="utf-8")
+@mock.patch.object(charm.hookenv, "charm_dir")
+def test_load_agent_conf_yaml_fallback(mock_charm_dir, harness, tmp_path):
+    """Test that agent.conf is parsed as YAML if fields can't be read by the simple reader."""
+    charm_path = tmp_path / "charm"
+    charm_path.mkdir()
+    (tmp_path / "agent.conf").write_text("cacert: 'CA DATA'\nupgradedToVersion: \"2.9.42.2\"\n")
+    mock_charm_dir.return_value = str(charm_path)
 
+    assert harness.charm.get_controller_ca_cert() == "CA DATA"
+    assert harness.charm.get_controller_version() == _CONTROLLER_V2_9
 
-def test_get_controller_ca_cert_from_config_success(harness):
-    """Test successfully parsing CA certificate from config option."""
-    ca_data = "VGhpcyBpcyB2YWxpZCBDQQ=="
-    with harness.hooks_disabled():
-        harness.update_config({"controller-ca-cert": ca_data})
 
-    expected_data = b64decode(ca_data).decode(encoding="ascii")
-    assert expected_data == harness.charm.get_controller_ca_cert()
+@pytest.mark.parametrize("file_changed", [True, False])
+def test_load_agent_conf_cache(file_changed, harness, mocker):
+    """Test that agent.conf is parsed again only if the file changed since the last read."""
+    mocker.patch.object(charm.hookenv, "charm_dir", return_value=_CHARM_PATH)
+    old_stat = mock.MagicMock(st_mtime=1.0, st_size=10)
+    new_stat = mock.MagicMock(st_mtime=2.0, st_size=10) if file_changed else old_stat
+    mocker.patch.object(charm.os, "stat", side_effect=[old_stat, new_stat])
 
+    with mock.patch("builtins.open", side_effect=_fake_open(_AGENT_CONF_COMPLETE)) as open_mock:
+        harness.charm.get_controller_version()
+        harness.charm.get_controller_ca_cert()
 
-def test_get_controller_ca_cert_from_config_fail(harness):
-    """Test failure when parsing CA certificate from config option."""
-    ca_data = "this_is-not valid b64"
-    with harness.hooks_disabled():
-        harness.update_config({"controller-ca-cert": ca_data})
+    assert open_mock.call_count == (2 if file_changed else 1)
 
-    with pytest.raises(RuntimeError):
-        harness.charm.get_controller_ca_cert()
+
+@pytest.fixture()
+def charm_with_mocked_ca(configured_harness, mocker):
+    """Return configurable harness with mocked controller CA cert and exporter version."""
+    mocker.patch.object(configured_harness.charm, "get_controller_ca_cert", return_value="ca")
+    mocker.patch.object(
+        configured_harness.charm.exporter, "version", return_value=_EXPORTER_V1_0_2
+    )
+    return configured_harness
 
 
-def test_generate_exporter_config_complete(harness, mocker):
+def test_generate_exporter_config_complete(charm_with_mocked_ca):
     """Test generating complete config file for exporter snap."""
     port = 5000
     controller = "juju-controller:17070"
@@ -203,12 +350,7 @@ def test_generate_exporter_config_complete(harness, mocker):
     debug = False
     prefixes = "TTT:TTT:TTT,FFF:FFF:FFF"
     match_interfaces = r"^(en[os]|eth)\d+|enp\d+s\d+|enx[0-9a-f]+"
-    mocker.patch.object(harness.charm, "get_controller_ca_cert", return_value=ca_cert)
-    mocker.patch.object(
-        exporter.ExporterConfig,
-        "controller_endpoint",
-        mock.PropertyMock(return_value=expected_controller),
-    )
+    charm_with_mocked_ca.charm.get_controller_ca_cert.return_value = ca_cert
 
     expected_snap_config = {
         "debug": debug,
@@ -232,46 +374,43 @@ def test_generate_exporter_config_complete(harness, mocker):
         },
     }
 
-    with harness.hooks_disabled():
-        harness.update_config(
-            {
-                "debug": debug,
-                "customer": customer,
-                "cloud-name": cloud,
-                "controller-url": controller,
-                "juju-user": user,
-                "juju-password": password,
-                "scrape-interval": interval,
-                "scrape-port": port,
-                "virtual-macs": prefixes,
-                "match-interfaces": match_interfaces,
-            }
-        )
-
-    snap_config = harness.charm.generate_exporter_config()
+    charm_with_mocked_ca.update_config(
+        {
+            "debug": debug,
+            "customer": customer,
+            "cloud-name": cloud,
+            "controller-url": controller,
+            "juju-user": user,
+            "juju-password": password,
+            "scrape-interval": interval,
+            "scrape-port": port,
+            "virtual-macs": prefixes,
+            "match-interfaces": match_interfaces,
+        }
+    )
+
+    snap_config = charm_with_mocked_ca.charm.generate_exporter_config()
 
     assert snap_config == expected_snap_config
 
 
-def test_generate_exporter_config_incomplete(harness, mocker):
+def test_generate_exporter_config_incomplete(charm_with_mocked_ca):
     """Test that generated config will have 'None' values for missing config options."""
     expected_missing_config = {"juju": ["controller_endpoint", "username", "password"]}
     expected_present_config = {"exporter": ["collect_interval", "port"]}
-    mocker.patch.object(harness.charm, "get_controller_ca_cert", return_value="ca")
-
-    with harness.hooks_disabled():
-        harness.update_config(
-            {
-                "controller-url": "",
-                "juju-user": "",
-                "juju-password": "",
-                "scrape-interval": 5,
-                "scrape-port": 5000,
-                "virtual-macs": "FFF:FFF:FFF",
-            }
-        )
-
-    snap_config = harness.charm.generate_exporter_config()
+
+    charm_with_mocked_ca.update_config(
+        {
+            "controller-url": "",
+            "juju-user": "",
+            "juju-password": "",
+            "scrape-interval": 5,
+            "scrape-port": 5000,
+            "virtual-macs": "FFF:FFF:FFF",
+        }
+    )
+
+    snap_config = charm_with_mocked_ca.charm.generate_exporter_config()
 
     for section, missing_keys in expected_missing_config.items():
         for key in missing_keys:
@@ -281,23 +420,25 @@ def test_generate_exporter_config_incomplete(harness, mocker):
         for key in present_keys:
             assert snap_config[section][key]
 
+    # snap is not queried when there's no controller endpoint to format
+    charm_with_mocked_ca.charm.exporter.version.assert_not_called()
 
-def test_reconfigure_scrape_target_success(harness, mocker):
+
+def test_reconfigure_scrape_target_success(configured_harness, mocker):
     """Test updating scrape target of Prometheus successfully."""
     port = 5000
     interval_min = 5
     interval_sec = interval_min * 60
     timeout = 30
     expose_target_mock = mocker.patch.object(
-        harness.charm.prometheus_target, "expose_scrape_target"
+        configured_harness.charm.prometheus_target, "expose_scrape_target"
     )
 
-    with harness.hooks_disabled():
-        harness.update_config(
-            {"scrape-port": port, "scrape-interval": interval_min, "scrape-timeout": timeout}
-        )
+    configured_harness.update_config(
+        {"scrape-port": port, "scrape-interval": interval_min, "scrape-timeout": timeout}
+    )
 
-    harness.charm.reconfigure_scrape_target()
+    configured_harness.charm.reconfigure_scrape_target()
     expose_target_mock.assert_called_once_with(
         port, "/metrics", scrape_interval=f"{interval_sec}s", scrape_timeout=f"{timeout}s"
     )
@@ -321,7 +462,7 @@ def test_reconfigure_scrape_target_fail(harness, mocker):
     )
 
 
-def test_reconfigure_open_ports(harness, mocker):
+def test_reconfigure_open_ports(configured_harness, mocker):
     """Test updating which ports are open on units."""
     old_port_spec = "5000/tcp"
     old_port, old_protocol = old_port_spec.split("/")
@@ -331,21 +472,33 @@ def test_reconfigure_open_ports(harness, mocker):
     mock_open_port = mocker.patch.object(charm.hookenv, "open_port")
     mock_close_port = mocker.patch.object(charm.hookenv, "close_port")
 
-    with harness.hooks_disabled():
-        harness.update_config({"scrape-port": new_port})
+    configured_harness.update_config({"scrape-port": new_port})
 
-    harness.charm.reconfigure_open_ports()
+    configured_harness.charm.reconfigure_open_ports()
 
     mock_close_port.assert_called_once_with(old_port, old_protocol)
     mock_open_port.assert_called_once_with(new_port)
 
 
+def test_reconfigure_open_ports_unchanged(configured_harness, mocker):
+    """Test that already opened scrape port is not closed and re-opened."""
+    port = 5000
+    mocker.patch.object(charm.hookenv, "opened_ports", return_value=[f"{port}/tcp", "6000/udp"])
+    mock_open_port = mocker.patch.object(charm.hookenv, "open_port")
+    mock_close_port = mocker.patch.object(charm.hookenv, "close_port")
+
+    configured_harness.update_config({"scrape-port": port})
+
+    configured_harness.charm.reconfigure_open_ports()
+
+    mock_close_port.assert_called_once_with("6000", "udp")
+    mock_open_port.assert_not_called()
+
+
 def test_on_install_callback_success(harness, mocker):
     """Test handling of InstallEvent with '_on_install' callback."""
     exporter_install = mocker.patch.object(harness.charm.exporter, "install")
-    mocker.patch.object(
-        harness.charm, "get_controller_version", return_value=version.parse("2.9.42.2")
-    )
+    mocker.patch.object(harness.charm, "get_controller_version", return_value=_CONTROLLER_V2_9)
     harness.charm._on_install(None)
     exporter_install.assert_called_once_with(harness.charm.snap_path, harness.charm.snap_channel)
     assert isinstance(harness.charm.unit.status, charm.MaintenanceStatus)
@@ -377,9 +530,7 @@ def test_on_stop(harness, mocker):
 def test_on_install_callback_fail(harness, mocker):
     """Test handling of error during InstallEvent."""
     snap_exception = charm.snap.CouldNotAcquireLockException
-    mocker.patch.object(
-        harness.charm, "get_controller_version", return_value=version.parse("2.9.42.2")
-    )
+    mocker.patch.object(harness.charm, "get_controller_version", return_value=_CONTROLLER_V2_9)
     exporter_install = mocker.patch.object(harness.charm.exporter, "install")
 
     exporter_install.side_effect = snap_exception
@@ -401,6 +552,27 @@ def test_on_config_changed_incomplete(harness, mocker):
     assert isinstance(harness.charm.unit.status, charm.BlockedStatus)
 
 
+def test_on_config_changed_error_translation(harness, mocker):
+    """Test that snap option names in config errors are replaced by charm option names."""
+    snap_error = (
+        "Following config options are missing: customer.name, customer.cloud_name\n"
+        "Configuration option 'exporter.port' must be a number."
+    )
+    expected_error = (
+        "Following config options are missing: customer, cloud-name\n"
+        "Configuration option 'scrape-port' must be a number."
+    )
+    mocker.patch.object(harness.charm, "generate_exporter_config", return_value={})
+    mocker.patch.object(
+        harness.charm.exporter, "apply_config", side_effect=charm.ExporterConfigError(snap_error)
+    )
+    logger_mock = mocker.patch.object(charm, "logger")
+
+    harness.charm._on_config_changed(None)
+
+    logger_mock.error.assert_called_once_with(expected_error)
+
+
 def test_on_config_changed_success(mocker, harness):
     """Test successful application of new config values."""
     valid_config = {"valid": "config"}
@@ -437,7 +609,10 @@ def test_on_prometheus_available(harness, mocker):
         (BlockedStatus, True, ActiveStatus),
     ],
 )
-def test_evaluate_status(current_status, service_running, expected_status, harness, mocker):
+@mock.patch.object(exporter.ExporterSnap, "is_running")
+def test_evaluate_status(
+    mock_is_running, current_status, service_running, expected_status, harness
+):
     """Test that wrapper that evaluates final unit status sets correct workload status.
 
     Expected behavior:
@@ -447,7 +622,7 @@ def test_evaluate_status(current_status, service_running, expected_status, harne
     Blocked             Yes                     Active
     Blocked             No                      Blocked
     """
-    mocker.patch.object(exporter.ExporterSnap, "is_running", return_value=service_running)
+    mock_is_running.return_value = service_running
     harness.charm.unit.status = current_status("Initial status")
 
     # trigger actual status evaluation wrapper via update-status event
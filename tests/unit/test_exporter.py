@@ -3,9 +3,13 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 """Unit tests for helper class ExporterSnap that handles actions related to the exporter snap."""
+import hashlib
+import os
+import re
 import subprocess
-from typing import Dict
-from unittest.mock import ANY, PropertyMock, mock_open, patch
+from types import SimpleNamespace
+from typing import Dict, Pattern
+from unittest.mock import PropertyMock, mock_open, patch
 
 import pytest
 import yaml
@@ -13,82 +17,199 @@ from packaging import version
 
 import exporter
 
+_EXPORTER_V1_0_1 = version.parse("1.0.1")
+_EXPORTER_V1_0_2 = version.parse("1.0.2")
+_MISSING_OPTIONS = ", ".join(
+    f"{section}.{option}"
+    for section, options in exporter.ExporterSnap._REQUIRED_OPTIONS
+    for option in options
+)
+
+
+def _literal_pattern(message: str) -> Pattern[str]:
+    """Compile regex pattern that matches message literally."""
+    return re.compile(re.escape(message))
 
-def validate_config_error(config: Dict, expected_error: str):
+
+def validate_config_error(
+    config: Dict, expected_error: Pattern[str], exporter_snap: exporter.ExporterSnap
+):
     """Run config validation and verify that expected error is present in the raised exception."""
-    exporter_ = exporter.ExporterSnap()
     with pytest.raises(exporter.ExporterConfigError, match=expected_error):
-        exporter_.validate_config(config)
+        exporter_snap.validate_config(config)
+
+
+@pytest.fixture()
+def patched(mocker) -> SimpleNamespace:
+    """Patch functions with side effects outside of the test and return namespace of the mocks."""
+    return SimpleNamespace(
+        snap_install=mocker.patch.object(exporter.snap, "snap_install"),
+        snap_remove=mocker.patch.object(exporter.snap, "snap_remove"),
+        subprocess_run=mocker.patch.object(exporter.subprocess, "run"),
+        subprocess_check_output=mocker.patch.object(exporter.subprocess, "check_output"),
+        service_running=mocker.patch.object(exporter.ch_host, "service_running"),
+    )
 
 
 @pytest.mark.parametrize("local_snap", [True, False])
-def test_exporter_snap_install(local_snap, mocker):
+def test_exporter_snap_install(local_snap, exporter_snap, patched, mocker):
     """Test method that install exporter snap from local file or from snap store."""
     snap_path = "/tmp/path/snap" if local_snap else None
-    mock_snap_install = mocker.patch.object(exporter.snap, "snap_install")
-
-    exporter_ = exporter.ExporterSnap()
+    mock_snap_install = patched.snap_install
+    mocker.patch.object(exporter.ExporterSnap, "_file_sha256", return_value="sha")
+    mocker.patch.object(exporter.ExporterSnap, "_installed_revision", side_effect=[None, "31"])
+    mock_write_state = mocker.patch.object(exporter.ExporterSnap, "_write_install_state")
+    mock_invalidate_version = mocker.patch.object(
+        exporter.ExporterSnap, "invalidate_version_cache"
+    )
 
-    exporter_.install(snap_path, "2.9/stable")
+    exporter_snap.install(snap_path, "2.9/stable")
 
     if local_snap:
         mock_snap_install.assert_called_once_with(snap_path, "--dangerous")
+        expected_state = {"channel": None, "resource_sha256": "sha", "revision": "31"}
     else:
-        mock_snap_install.assert_called_once_with(exporter_.SNAP_NAME, "--channel", "2.9/stable")
+        mock_snap_install.assert_called_once_with(
+            exporter_snap.SNAP_NAME, "--channel", "2.9/stable"
+        )
+        expected_state = {"channel": "2.9/stable", "resource_sha256": None, "revision": "31"}
+
+    mock_write_state.assert_called_once_with(expected_state)
+    mock_invalidate_version.assert_called_once_with()
+
+
+@pytest.mark.parametrize(
+    "recorded_state, expect_install",
+    [
+        ({"channel": "2.9/stable", "resource_sha256": None, "revision": "31"}, False),
+        ({"channel": "2.9/stable", "resource_sha256": None, "revision": "30"}, True),
+        ({"channel": "2.8/stable", "resource_sha256": None, "revision": "31"}, True),
+        (None, True),
+    ],
+)
+def test_exporter_snap_install_skip(
+    recorded_state, expect_install, exporter_snap, patched, mocker
+):
+    """Test that snap installation is skipped if the snap is installed from requested source."""
+    mock_snap_install = patched.snap_install
+    mocker.patch.object(exporter.ExporterSnap, "_installed_revision", return_value="31")
+    mocker.patch.object(exporter.ExporterSnap, "_read_install_state", return_value=recorded_state)
+    mocker.patch.object(exporter.ExporterSnap, "_write_install_state")
+
+    exporter_snap.install(None, "2.9/stable")
+
+    assert mock_snap_install.called == expect_install
+
+
+@pytest.mark.parametrize("installed", [True, False])
+def test_exporter_snap_installed_revision(installed, exporter_snap, mocker):
+    """Test detecting revision of installed snap from its 'current' symlink."""
+    mock_readlink = mocker.patch.object(exporter.os, "readlink", return_value="31")
+    if not installed:
+        mock_readlink.side_effect = FileNotFoundError
+
+    assert exporter_snap._installed_revision() == ("31" if installed else None)
+    mock_readlink.assert_called_once_with(exporter_snap.SNAP_CURRENT_PATH)
 
 
-def test_exporter_snap_uninstall(mocker):
+def test_exporter_snap_install_state_roundtrip(tmp_path, exporter_snap, mocker):
+    """Test writing and reading back recorded install state."""
+    state_path = tmp_path / "install-state.json"
+    mocker.patch.object(exporter.ExporterSnap, "SNAP_INSTALL_STATE_PATH", str(state_path))
+    state = {"channel": "2.9/stable", "resource_sha256": None, "revision": "31"}
+
+    assert exporter_snap._read_install_state() is None
+
+    exporter_snap._write_install_state(state)
+
+    assert exporter_snap._read_install_state() == state
+
+
+def test_exporter_snap_install_state_write_fail(tmp_path, exporter_snap, mocker):
+    """Test that failure to record install state is only logged."""
+    state_path = tmp_path / "missing" / "install-state.json"
+    mocker.patch.object(exporter.ExporterSnap, "SNAP_INSTALL_STATE_PATH", str(state_path))
+    mock_logger = mocker.patch.object(exporter, "logger")
+
+    exporter_snap._write_install_state({})
+
+    mock_logger.warning.assert_called_once()
+
+
+def test_exporter_snap_file_sha256(tmp_path):
+    """Test calculating sha256 digest of a local snap file."""
+    snap_file = tmp_path / "exporter.snap"
+    snap_file.write_bytes(b"snap data")
+    expected_digest = hashlib.sha256(b"snap data").hexdigest()
+
+    assert exporter.ExporterSnap._file_sha256(str(snap_file)) == expected_digest
+
+
+def test_exporter_snap_uninstall(exporter_snap, patched, mocker):
     """Test uninstallation of exporter snap."""
-    snap_remove_mock = mocker.patch.object(exporter.snap, "snap_remove")
+    mock_invalidate_version = mocker.patch.object(
+        exporter.ExporterSnap, "invalidate_version_cache"
+    )
 
-    exporter_ = exporter.ExporterSnap()
-    exporter_.uninstall()
+    exporter_snap.uninstall()
 
-    snap_remove_mock.assert_called_once_with(exporter_.SNAP_NAME)
+    patched.snap_remove.assert_called_once_with(exporter_snap.SNAP_NAME)
+    mock_invalidate_version.assert_called_once_with()
 
 
-def test_validate_config_missing_fields():
+def test_validate_config_missing_fields(exporter_snap):
     """Test config validation with all required fields missing."""
-    missing_options = ", ".join(exporter.ExporterSnap._REQUIRED_CONFIG)
-    expected_err = f"Following config options are missing: {missing_options}"
+    expected_err = _literal_pattern(f"Following config options are missing: {_MISSING_OPTIONS}")
 
-    validate_config_error({}, expected_err)
+    validate_config_error({}, expected_err, exporter_snap)
 
 
-def test_validate_config_port_not_number():
-    """Test config validation when port is not defined as number."""
-    config = {"exporter": {"port": "foo"}}
-    expected_err = "Configuration option 'port' must be a number."
+def test_validate_config_section_not_dict(exporter_snap):
+    """Test config validation when config section holds a value instead of nested options."""
+    config = {"customer": "Test Org"}
+    expected_err = _literal_pattern(
+        "Following config options are missing: customer.name, customer.cloud_name"
+    )
 
-    validate_config_error(config, expected_err)
+    validate_config_error(config, expected_err, exporter_snap)
 
 
 @pytest.mark.parametrize(
-    "port",
+    "config, expected_err",
     [
-        0,  # too low
-        65536,  # too high
+        pytest.param(
+            {"exporter": {"port": "foo"}},
+            _literal_pattern("Configuration option 'port' must be a number."),
+            id="port-not-number",
+        ),
+        pytest.param(
+            {"exporter": {"port": 0}},
+            _literal_pattern("Port 0 is not valid port number."),
+            id="port-too-low",
+        ),
+        pytest.param(
+            {"exporter": {"port": 65536}},
+            _literal_pattern("Port 65536 is not valid port number."),
+            id="port-too-high",
+        ),
+        pytest.param(
+            {"exporter": {"collect_interval": "foo"}},
+            _literal_pattern("Configuration option 'collect_interval' must be a number."),
+            id="refresh-not-number",
+        ),
+        pytest.param(
+            {"exporter": {"collect_interval": 0}},
+            _literal_pattern("Configuration option 'collect_interval' must be a positive number."),
+            id="refresh-below-one",
+        ),
     ],
 )
-def test_validate_config_port_out_of_range(port):
-    """Test config validation when port is defined out of allowed range."""
-    expected_error = f"Port {port} is not valid port number."
-    validate_config_error({"exporter": {"port": port}}, expected_error)
-
+def test_validate_config_invalid(config, expected_err, exporter_snap):
+    """Test config validation when port or 'refresh' option has invalid value."""
+    validate_config_error(config, expected_err, exporter_snap)
 
-def test_validate_configrefresh_not_number():
-    """Test config validation when 'refresh' option is not a number."""
-    expected_err = "Configuration option 'collect_interval' must be a number."
-    validate_config_error({"exporter": {"collect_interval": "foo"}}, expected_err)
 
-
-def test_validate_config_refresh_below_zero():
-    """Test config validation when 'refresh' option is less than 1."""
-    expected_err = "Configuration option 'collect_interval' must be a positive number."
-    validate_config_error({"exporter": {"collect_interval": 0}}, expected_err)
-
-
-def test_validate_config():
+def test_validate_config(exporter_snap):
     """Test positively validating snap exporter config."""
     config = {
         "debug": False,
@@ -109,36 +230,114 @@ def test_validate_config():
         },
     }
 
-    exporter_ = exporter.ExporterSnap()
-
     try:
-        exporter_.validate_config(config)
+        exporter_snap.validate_config(config)
     except exporter.ExporterConfigError:
         pytest.fail("Configuration expected to pass but did not.")
 
 
-def test_apply_config_success(mocker):
+def _config_header(config: Dict) -> bytes:
+    """Return expected content-version header of a config file for supplied config."""
+    config_hash = hashlib.blake2b(yaml.safe_dump(config).encode("utf-8"), digest_size=16)
+    return f"# content-version: {config_hash.hexdigest()}\n".encode("utf-8")
+
+
+@pytest.fixture()
+def mocked_config_file(mocker) -> SimpleNamespace:
+    """Patch low-level file operations used to write exporter config and return their mocks."""
+    return SimpleNamespace(
+        open=mocker.patch.object(exporter.os, "open", return_value=3),
+        fchmod=mocker.patch.object(exporter.os, "fchmod"),
+        fdopen=mocker.patch.object(exporter.os, "fdopen", new_callable=mock_open),
+        fsync=mocker.patch.object(exporter.os, "fsync"),
+        replace=mocker.patch.object(exporter.os, "replace"),
+        unlink=mocker.patch.object(exporter.os, "unlink"),
+    )
+
+
+def test_apply_config_success(exporter_snap, mocked_config_file, mocker):
     """Test successfully applying snap configuration."""
     mock_stop = mocker.patch.object(exporter.ExporterSnap, "stop")
     mock_start = mocker.patch.object(exporter.ExporterSnap, "restart")
-    mock_dump = mocker.patch.object(exporter.yaml, "safe_dump")
     mock_validate = mocker.patch.object(exporter.ExporterSnap, "validate_config")
-    mock_os_chmod = mocker.patch.object(exporter.os, "chmod")
+    mocker.patch.object(exporter.ExporterSnap, "_read_config_header", return_value=b"")
+    config = {"valid": "config"}
+    expected_content = _config_header(config) + yaml.safe_dump(config).encode("utf-8")
+    tmp_path = f"{exporter_snap.SNAP_CONFIG_PATH}.tmp"
+
+    exporter_snap.apply_config(config)
+
+    mock_stop.assert_not_called()
+    mock_validate.assert_called_once_with(config)
+    mocked_config_file.open.assert_called_once_with(
+        tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+    )
+    mocked_config_file.fdopen.assert_called_once_with(3, "wb")
+    mocked_config_file.fchmod.assert_called_once_with(mocked_config_file.fdopen().fileno(), 0o600)
+    mocked_config_file.fdopen().write.assert_called_once_with(expected_content)
+    mocked_config_file.fsync.assert_called_once_with(mocked_config_file.fdopen().fileno())
+    mocked_config_file.replace.assert_called_once_with(tmp_path, exporter_snap.SNAP_CONFIG_PATH)
+    mocked_config_file.unlink.assert_not_called()
+    mock_start.assert_called_once_with()
+
+
+@pytest.mark.parametrize("failing_call", ["fchmod", "fsync", "replace"])
+def test_apply_config_write_fail(failing_call, exporter_snap, mocked_config_file, mocker):
+    """Test that temporary config file is removed if writing of new config fails."""
+    mock_start = mocker.patch.object(exporter.ExporterSnap, "restart")
+    mocker.patch.object(exporter.ExporterSnap, "validate_config")
+    mocker.patch.object(exporter.ExporterSnap, "_read_config_header", return_value=b"")
+    getattr(mocked_config_file, failing_call).side_effect = OSError
+
+    with pytest.raises(OSError):
+        exporter_snap.apply_config({"valid": "config"})
+
+    mocked_config_file.unlink.assert_called_once_with(f"{exporter_snap.SNAP_CONFIG_PATH}.tmp")
+    mocked_config_file.fdopen().__exit__.assert_called_once()  # file descriptor was closed
+    mock_start.assert_not_called()
+
+
+@pytest.mark.parametrize("running", [True, False])
+def test_apply_config_unchanged(running, exporter_snap, mocked_config_file, mocker):
+    """Test that unchanged config is re-applied only if the service is not running."""
+    mock_start = mocker.patch.object(exporter.ExporterSnap, "restart")
+    mocker.patch.object(exporter.ExporterSnap, "validate_config")
+    mocker.patch.object(exporter.ExporterSnap, "is_running", return_value=running)
+    config = {"valid": "config"}
+    mocker.patch.object(
+        exporter.ExporterSnap, "_read_config_header", return_value=_config_header(config)
+    )
+
+    exporter_snap.apply_config(config)
+
+    assert mocked_config_file.open.called != running
+    assert mock_start.called != running
+
+
+def test_apply_config_restart_fail(exporter_snap, tmp_path, mocker):
+    """Test that config is re-applied if the service failed to restart with it previously."""
+    config_path = tmp_path / "config.yaml"
+    mocker.patch.object(exporter.ExporterSnap, "SNAP_CONFIG_PATH", str(config_path))
+    mocker.patch.object(exporter.ExporterSnap, "validate_config")
+    mocker.patch.object(exporter.ExporterSnap, "is_running", return_value=True)
+    mock_restart = mocker.patch.object(
+        exporter.ExporterSnap, "restart", side_effect=[exporter.ExporterSnapError, None]
+    )
     config = {"valid": "config"}
-    exporter_ = exporter.ExporterSnap()
 
-    with patch("builtins.open", new_callable=mock_open) as file_:
-        exporter_.apply_config(config)
+    with pytest.raises(exporter.ExporterSnapError):
+        exporter_snap.apply_config(config)
+
+    assert config_path.read_bytes() == yaml.safe_dump(config).encode("utf-8")
+    assert (config_path.stat().st_mode & 0o777) == 0o600
+
+    exporter_snap.apply_config(config)
 
-        mock_stop.assert_called_once_with()
-        mock_validate.assert_called_once_with(config)
-        mock_dump.assert_called_once_with(config, ANY)
-        file_.assert_called_once_with(exporter_.SNAP_CONFIG_PATH, "w", encoding="utf-8")
-        mock_os_chmod.assert_called_once_with(exporter_.SNAP_CONFIG_PATH, 0o600)
-        mock_start.assert_called_once_with()
+    assert mock_restart.call_count == 2
+    assert config_path.read_bytes().startswith(_config_header(config))
 
 
-def test_apply_config_fail(mocker):
+def test_apply_config_fail(exporter_snap, mocked_config_file, mocker):
     """Test failure to apply snap configuration.
 
     In case of failure, old config should not be overwritten
@@ -146,109 +345,316 @@ def test_apply_config_fail(mocker):
     """
     mock_stop = mocker.patch.object(exporter.ExporterSnap, "stop")
     mock_start = mocker.patch.object(exporter.ExporterSnap, "restart")
-    mock_dump = mocker.patch.object(exporter.yaml, "safe_dump")
     mock_validate = mocker.patch.object(exporter.ExporterSnap, "validate_config")
+    mocker.patch.object(exporter.ExporterSnap, "_read_config_header", return_value=b"")
     config = {}
-    exporter_ = exporter.ExporterSnap()
 
     mock_validate.side_effect = exporter.ExporterConfigError
-    with patch("builtins.open", new_callable=mock_open):
-        with pytest.raises(exporter.ExporterConfigError):
-            exporter_.apply_config(config)
+    with pytest.raises(exporter.ExporterConfigError):
+        exporter_snap.apply_config(config)
 
     mock_stop.assert_called_once_with()
     mock_validate.assert_called_once_with(config)
-    mock_dump.assert_not_called()
+    mocked_config_file.open.assert_not_called()
     mock_start.assert_not_called()
 
 
+@pytest.mark.parametrize("exists", [True, False])
+def test_read_config_header(exists, tmp_path, exporter_snap, mocker):
+    """Test reading content-version header of the current config file."""
+    config_path = tmp_path / "config.yaml"
+    if exists:
+        config_path.write_bytes(b"# content-version: abcd\ndebug: false\n")
+    mocker.patch.object(exporter.ExporterSnap, "SNAP_CONFIG_PATH", str(config_path))
+
+    expected_header = b"# content-version: abcd\n" if exists else b""
+
+    assert exporter_snap._read_config_header() == expected_header
+
+
 @pytest.mark.parametrize(
-    "action",
+    "action, expected_command",
     [
-        "start",
-        "stop",
-        "restart",
+        (action, ["snap", action, exporter.ExporterSnap.SNAP_NAME])
+        for action in ("start", "stop", "restart")
     ],
 )
-def test_exporter_service_actions(action, mocker):
-    """Test running available actions on exporter service."""
-    mock_action = mocker.patch.object(exporter.ExporterSnap, "_execute_service_action")
+def test_exporter_service_actions(action, expected_command, exporter_snap, patched, mocker):
+    """Test running available actions on exporter service via snap command."""
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_service_action", return_value=False)
+
+    getattr(exporter_snap, action)()
+
+    patched.subprocess_run.assert_called_once_with(
+        expected_command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+
 
-    exporter_ = exporter.ExporterSnap()
-    getattr(exporter_, action)()
+def test_execute_service_action_fail(exporter_snap, patched, mocker):
+    """Test that '_execute_service_action' raises error if the snap command fails."""
+    err = subprocess.CalledProcessError(1, "snap restart", stderr=b"error: snap not found\n")
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_service_action", return_value=False)
+    patched.subprocess_run.side_effect = err
+    expected_error = f"Failed to restart {exporter_snap.SNAP_NAME} service: error: snap not found"
 
-    mock_action.assert_called_once_with(action)
+    with pytest.raises(exporter.ExporterSnapError) as exc_info:
+        exporter_snap._execute_service_action("restart")
 
+    assert str(exc_info.value) == expected_error
 
-def test_execute_service_action(mocker):
-    """Test internal method that executes snap service actions."""
-    mock_call = mocker.patch.object(exporter.subprocess, "call")
-    action = "restart"
-    exporter_ = exporter.ExporterSnap()
-    expected_command = ["snap", action, exporter_.SNAP_NAME]
 
-    exporter_._execute_service_action(action)
+def test_execute_service_action_snapd(exporter_snap, patched, mocker):
+    """Test that service action executed via snapd API does not spawn snap CLI."""
+    mock_snapd_action = mocker.patch.object(
+        exporter.ExporterSnap, "_snapd_service_action", return_value=True
+    )
+
+    exporter_snap._execute_service_action("restart")
+
+    mock_snapd_action.assert_called_once_with("restart")
+    patched.subprocess_run.assert_not_called()
+
+
+def test_snapd_service_action(exporter_snap, mocker):
+    """Test executing service action via snapd API and waiting for its change to finish."""
+    mock_sleep = mocker.patch.object(exporter.time, "sleep")
+    mock_request = mocker.patch.object(
+        exporter.ExporterSnap,
+        "_snapd_request",
+        side_effect=[
+            {"type": "async", "status-code": 202, "change": "42"},
+            {"type": "sync", "result": {"ready": False, "status": "Doing"}},
+            {"type": "sync", "result": {"ready": True, "status": "Done"}},
+        ],
+    )
+
+    assert exporter_snap._snapd_service_action("restart") is True
+
+    mock_request.assert_any_call(
+        "POST", "/v2/apps", {"action": "restart", "names": [exporter_snap.SNAP_NAME]}
+    )
+    mock_request.assert_called_with("GET", "/v2/changes/42")
+    mock_sleep.assert_called_once_with(exporter_snap.SNAPD_CHANGE_POLL_INTERVAL)
+
+
+def test_snapd_service_action_unavailable(exporter_snap, mocker):
+    """Test that service action is not executed via snapd API if the API is not reachable."""
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_request", side_effect=FileNotFoundError)
+
+    assert exporter_snap._snapd_service_action("restart") is False
+
+
+@pytest.mark.parametrize(
+    "responses",
+    [
+        # snapd refuses the action
+        [{"type": "error", "status-code": 400, "result": {"message": "bad request"}}],
+        # change finishes with an error
+        [
+            {"type": "async", "status-code": 202, "change": "42"},
+            {"type": "sync", "result": {"ready": True, "status": "Error", "err": "failed"}},
+        ],
+        # snapd becomes unreachable while waiting for the change
+        [{"type": "async", "status-code": 202, "change": "42"}, ConnectionResetError],
+        # change does not finish in time
+        [
+            {"type": "async", "status-code": 202, "change": "42"},
+            {"type": "sync", "result": {"ready": False, "status": "Doing"}},
+        ],
+    ],
+)
+def test_snapd_service_action_fail(responses, exporter_snap, mocker):
+    """Test failures of service action executed via snapd API."""
+    mocker.patch.object(exporter.time, "sleep")
+    mocker.patch.object(exporter.time, "monotonic", side_effect=[0, 1000])
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_request", side_effect=responses)
+
+    with pytest.raises(exporter.ExporterSnapError):
+        exporter_snap._snapd_service_action("restart")
+
+
+def test_snapd_service_action_change_error(exporter_snap, mocker):
+    """Test that error reported by snapd while waiting for the change is raised immediately."""
+    mock_sleep = mocker.patch.object(exporter.time, "sleep")
+    mocker.patch.object(
+        exporter.ExporterSnap,
+        "_snapd_request",
+        side_effect=[
+            {"type": "async", "status-code": 202, "change": "42"},
+            {"type": "error", "status-code": 404, "result": {"message": "change not found"}},
+        ],
+    )
 
-    mock_call.assert_called_once_with(expected_command)
+    with pytest.raises(exporter.ExporterSnapError, match="change not found"):
+        exporter_snap._snapd_service_action("restart")
 
+    mock_sleep.assert_not_called()
 
-def test_execute_service_action_unknown(mocker):
+
+def test_execute_service_action_unknown(exporter_snap, patched):
     """Test that '_execute_service_action' raises error if it does not recognize the action."""
-    mock_call = mocker.patch.object(exporter.subprocess, "call")
     bad_action = "foo"
 
-    exporter_ = exporter.ExporterSnap()
     with pytest.raises(RuntimeError):
-        exporter_._execute_service_action(bad_action)
+        exporter_snap._execute_service_action(bad_action)
 
-    mock_call.assert_not_called()
+    patched.subprocess_run.assert_not_called()
 
 
-def test_service_name():
+def test_service_name(exporter_snap):
     """Test that `service_name` property returns expected value."""
-    exporter_ = exporter.ExporterSnap()
-    expected_service = f"snap.{exporter_.SNAP_NAME}.{exporter_.SNAP_NAME}.service"
+    expected_service = f"snap.{exporter_snap.SNAP_NAME}.{exporter_snap.SNAP_NAME}.service"
 
-    assert exporter_.service_name == expected_service
+    assert exporter_snap.service_name == expected_service
 
 
 @pytest.mark.parametrize("running", [True, False])
-def test_exporter_service_running(running, mocker):
+def test_exporter_service_running(running, exporter_snap, patched, mocker):
     """Test that `is_running` method returns True/False based on service status."""
-    mock_service_running = mocker.patch.object(
-        exporter.ch_host, "service_running", return_value=running
-    )
+    mocker.patch("builtins.open", side_effect=FileNotFoundError)
+    patched.service_running.return_value = running
 
-    exporter_ = exporter.ExporterSnap()
+    assert exporter_snap.is_running() == running
+    patched.service_running.assert_called_once_with(exporter_snap.service_name)
 
-    assert exporter_.is_running() == running
-    mock_service_running.assert_called_once_with(exporter_.service_name)
 
+@pytest.mark.parametrize(
+    "procs, expect_fallback",
+    [
+        (b"1234\n", False),  # processes in service's cgroup, service is running
+        (b"", True),  # empty cgroup, ask systemd
+    ],
+)
+def test_exporter_service_running_cgroup(procs, expect_fallback, exporter_snap, patched):
+    """Test that `is_running` checks service's cgroup before querying systemd."""
+    patched.service_running.return_value = False
+    expected_path = exporter_snap._SERVICE_CGROUP_PATHS[1].format(exporter_snap.service_name)
+    open_mock = mock_open(read_data=procs)
+    open_mock.side_effect = [FileNotFoundError, open_mock.return_value]
+
+    with patch("builtins.open", open_mock):
+        assert exporter_snap.is_running() != expect_fallback
+
+    open_mock.assert_called_with(expected_path, "rb")
+    assert patched.service_running.called == expect_fallback
 
-def test_exporter_snap_version_success(snap_info_1_0_1, mocker):
+
+def test_exporter_snap_version_success(snap_info_1_0_1_yaml, patched, mocker):
     """Test successfully detecting exporter snap version."""
-    expected_version = version.parse("1.0.1")
-    cmd_output = yaml.dump(snap_info_1_0_1)
-    mocker.patch.object(exporter.subprocess, "check_output", return_value=cmd_output)
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_version", return_value=None)
+    expected_version = _EXPORTER_V1_0_1
+    patched.subprocess_check_output.return_value = snap_info_1_0_1_yaml
 
     assert exporter.ExporterSnap.version() == expected_version
 
 
-def test_exporter_snap_version_not_installed(snap_info_1_0_1, mocker):
+def test_exporter_snap_version_cached(snap_info_1_0_1_yaml, patched, mocker):
+    """Test that exporter snap version is detected only once until the cache is invalidated."""
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_version", return_value=None)
+    patched.subprocess_check_output.return_value = snap_info_1_0_1_yaml
+
+    first_version = exporter.ExporterSnap.version()
+    assert exporter.ExporterSnap.version() is first_version
+    patched.subprocess_check_output.assert_called_once()
+
+    exporter.ExporterSnap.invalidate_version_cache()
+    exporter.ExporterSnap.version()
+    assert patched.subprocess_check_output.call_count == 2
+
+
+def test_exporter_snap_version_snapd(patched, mocker):
+    """Test that exporter snap version reported by snapd API takes precedence over snap CLI."""
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_version", return_value="1.0.2")
+
+    assert exporter.ExporterSnap.version() == _EXPORTER_V1_0_2
+    patched.subprocess_check_output.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "response, expected_version",
+    [
+        ({"type": "sync", "status-code": 200, "result": {"version": "1.0.2"}}, "1.0.2"),
+        ({"type": "error", "status-code": 500, "result": {"message": "boom"}}, None),
+        ({"type": "sync", "status-code": 200, "result": None}, None),
+        (OSError("No such file or directory"), None),
+        (ValueError("Expecting value"), None),
+    ],
+)
+def test_exporter_snap_snapd_version(response, expected_version, mocker):
+    """Test parsing of snap version from snapd API response."""
+    if isinstance(response, Exception):
+        mocker.patch.object(exporter.ExporterSnap, "_snapd_request", side_effect=response)
+    else:
+        mocker.patch.object(exporter.ExporterSnap, "_snapd_request", return_value=response)
+
+    assert exporter.ExporterSnap._snapd_version() == expected_version
+
+
+def test_exporter_snap_snapd_version_not_installed(mocker):
+    """Test that snap version reported by snapd API fails if the snap is not installed."""
+    response = {"type": "error", "status-code": 404, "result": {"kind": "snap-not-found"}}
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_request", return_value=response)
+
+    with pytest.raises(exporter.ExporterSnapError):
+        exporter.ExporterSnap._snapd_version()
+
+
+def test_exporter_snap_snapd_request(mocker):
+    """Test sending request to snapd REST API."""
+    mock_connection = mocker.patch.object(exporter, "_SnapdConnection")
+    connection = mock_connection.return_value
+    connection.getresponse.return_value.read.return_value = b'{"type": "sync"}'
+
+    response = exporter.ExporterSnap._snapd_request("GET", "/v2/snaps/foo")
+
+    assert response == {"type": "sync"}
+    mock_connection.assert_called_once_with(exporter.ExporterSnap.SNAPD_SOCKET_PATH)
+    connection.request.assert_called_once_with("GET", "/v2/snaps/foo")
+    connection.close.assert_called_once_with()
+
+
+def test_exporter_snap_snapd_request_body(mocker):
+    """Test sending request with JSON body to snapd REST API."""
+    mock_connection = mocker.patch.object(exporter, "_SnapdConnection")
+    connection = mock_connection.return_value
+    connection.getresponse.return_value.read.return_value = b'{"type": "async"}'
+
+    exporter.ExporterSnap._snapd_request("POST", "/v2/apps", {"action": "stop"})
+
+    connection.request.assert_called_once_with(
+        "POST",
+        "/v2/apps",
+        body=b'{"action": "stop"}',
+        headers={"Content-Type": "application/json"},
+    )
+
+
+def test_snapd_connection_connect(mocker):
+    """Test that connection to snapd goes through its unix socket."""
+    mock_socket = mocker.patch.object(exporter.socket, "socket")
+    connection = exporter._SnapdConnection("/run/snapd.socket", timeout=10)
+
+    connection.connect()
+
+    mock_socket.assert_called_once_with(exporter.socket.AF_UNIX, exporter.socket.SOCK_STREAM)
+    mock_socket.return_value.settimeout.assert_called_once_with(10)
+    mock_socket.return_value.connect.assert_called_once_with("/run/snapd.socket")
+
+
+def test_exporter_snap_version_not_installed(snap_info_not_installed_yaml, patched, mocker):
     """Test failure to detect exporter snap version when snap is not installed."""
-    snap_info = snap_info_1_0_1.copy()
-    snap_info.pop("installed")
-    cmd_output = yaml.dump(snap_info)
-    mocker.patch.object(exporter.subprocess, "check_output", return_value=cmd_output)
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_version", return_value=None)
+    patched.subprocess_check_output.return_value = snap_info_not_installed_yaml
 
     with pytest.raises(exporter.ExporterSnapError):
         _ = exporter.ExporterSnap.version()
 
 
-def test_exporter_snap_version_failure(mocker):
+def test_exporter_snap_version_failure(patched, mocker):
     """Test failure to get snap info when detecting exporter snap version."""
+    mocker.patch.object(exporter.ExporterSnap, "_snapd_version", return_value=None)
     err = subprocess.CalledProcessError(1, "snap info", "Command not found")
-    mocker.patch.object(exporter.subprocess, "check_output", side_effect=err)
+    patched.subprocess_check_output.side_effect = err
 
     with pytest.raises(exporter.ExporterSnapError):
         _ = exporter.ExporterSnap.version()
@@ -257,8 +663,8 @@ def test_exporter_snap_version_failure(mocker):
 @pytest.mark.parametrize(
     "exporter_version, expected_value",
     [
-        (version.parse("1.0.1"), "10.0.0.1:17070"),
-        (version.parse("1.0.2"), ["10.0.0.1:17070"]),
+        (_EXPORTER_V1_0_1, "10.0.0.1:17070"),
+        (_EXPORTER_V1_0_2, ["10.0.0.1:17070"]),
     ],
 )
 def test_exporter_config_controller_endpoint(exporter_version, expected_value, mocker):
@@ -275,13 +681,24 @@ def test_exporter_config_controller_endpoint(exporter_version, expected_value, m
     assert config.controller_endpoint == expected_value
 
 
+def test_exporter_config_controller_endpoint_installed_version(mocker):
+    """Test that ExporterConfig.controller_endpoint prefers explicitly supplied snap version."""
+    version_mock = mocker.patch.object(exporter.ExporterSnap, "version")
+    config = exporter.ExporterConfig(
+        controller="10.0.0.1:17070", installed_version=_EXPORTER_V1_0_1
+    )
+
+    assert config.controller_endpoint == "10.0.0.1:17070"
+    version_mock.assert_not_called()
+
+
 def test_exporter_config_controller_endpoint_incompatible(mocker):
     """Test incompatibilities between 'controller_endpoint' value and installed exporter.
 
     Only prometheus-juju-exporter > 1.0.1 can accept comma-separated list of controller
     endpoints.
     """
-    exporter_version = version.parse("1.0.1")
+    exporter_version = _EXPORTER_V1_0_1
     mocker.patch.object(exporter.ExporterSnap, "version", return_value=exporter_version)
     invalid_endpoints = "10.0.0.1:17070,10.0.0.2:17070"
     config = exporter.ExporterConfig(controller=invalid_endpoints)
@@ -353,3 +770,17 @@ def test_exporter_config_render_defaults(mocker):
     )
 
     assert config.render() == expected_config
+
+
+def test_exporter_config_render_unknown_version(mocker):
+    """Test that rendered config follows changes of the currently installed snap version."""
+    mock_version = mocker.patch.object(
+        exporter.ExporterSnap, "version", return_value=_EXPORTER_V1_0_2
+    )
+    config = exporter.ExporterConfig(controller="10.0.0.1:17070,10.0.0.2:17070")
+
+    assert config.render()["juju"]["controller_endpoint"] == ["10.0.0.1:17070", "10.0.0.2:17070"]
+
+    mock_version.return_value = _EXPORTER_V1_0_1
+    with pytest.raises(exporter.ExporterConfigError):
+        config.render()